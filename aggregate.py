@@ -0,0 +1,95 @@
+'''Aggregate the results of by_age_group.py over groupings of jurisdictions.
+
+A grouping maps labels to lists of jurisdictions, e.g. {'democrat':
+['California', ...], 'republican': [...]} for the party of governors. All
+groupings are turned into a single membership matrix (one row per label, one
+column per jurisdiction), and the observed deaths, expected deaths and
+population of all jurisdictions and age groups are aggregated at once by one
+matrix product.
+
+The membership matrix is sparse if scipy is installed, dense otherwise.'''
+
+import json
+import numpy as np
+import pandas as pd
+
+# Names of the REGION and DIVISION codes of Population.csv
+region_names = {1: 'Northeast', 2: 'Midwest', 3: 'South', 4: 'West'}
+division_names = {
+    1: 'New England',
+    2: 'Middle Atlantic',
+    3: 'East North Central',
+    4: 'West North Central',
+    5: 'South Atlantic',
+    6: 'East South Central',
+    7: 'West South Central',
+    8: 'Mountain',
+    9: 'Pacific',
+}
+
+def by_key(d, names=None):
+    '''Return a grouping of the keys of the dict <d> by their value, mapped
+    through <names> if specified'''
+    labels = {}
+    for (j, v) in d.items():
+        labels.setdefault(names.get(v, str(v)) if names else v, []).append(j)
+    return labels
+
+def census_groupings(geo):
+    '''Return the groupings by census region and division, given the dict
+    <geo> mapping jurisdictions to their (region, division) codes'''
+    return {
+        'Census region': by_key({j: r for (j, (r, d)) in geo.items()}, region_names),
+        'Census division': by_key({j: d for (j, (r, d)) in geo.items()}, division_names),
+    }
+
+def load_groupings(path):
+    '''Return the custom groupings of the JSON file <path>, like
+    {"Grouping": {"Label": ["Jurisdiction", ...], ...}, ...}'''
+    return json.load(open(path))
+
+def membership(groupings, jurisdictions):
+    '''Return the (grouping, label) of each row of the membership matrix of
+    <groupings>, and the matrix, of one column per jurisdiction of
+    <jurisdictions>; jurisdictions not in <jurisdictions> are ignored'''
+    col = {j: i for (i, j) in enumerate(jurisdictions)}
+    (rows, cols, index) = ([], [], [])
+    for (name, labels) in groupings.items():
+        for (label, members) in labels.items():
+            for j in members:
+                if j in col:
+                    rows.append(len(index))
+                    cols.append(col[j])
+            index.append((name, label))
+    shape = (len(index), len(jurisdictions))
+    try:
+        # imported here as it takes long to import, and is only needed here
+        import scipy.sparse
+        m = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+    except ImportError:
+        m = np.zeros(shape)
+        m[rows, cols] = 1
+    return index, m
+
+def aggregate(results, pop, groupings):
+    '''Return a DataFrame of the observed and expected deaths, population,
+    excess deaths and excess deaths per 1M people of each label of
+    <groupings>, indexed by (grouping, label, age group). <results> is a
+    table like by_age_group.my_excess, and <pop> the population of each
+    jurisdiction and age group. Like the jurisdictions, a label only counts
+    the population of the cells found in <results>.'''
+    obs = results['Observed'].unstack()
+    exp = results['Expected'].unstack().reindex_like(obs)
+    (jurisdictions, groups) = (list(obs.index), list(obs.columns))
+    p = np.array([[pop[j][g] for g in groups] for j in jurisdictions], dtype=float)
+    p[obs.isnull().to_numpy()] = 0
+    # (jurisdiction x (observed, expected, population) for each age group)
+    v = np.hstack([obs.fillna(0).to_numpy(), exp.fillna(0).to_numpy(), p])
+    (index, m) = membership(groupings, jurisdictions)
+    a = np.asarray(m @ v).reshape(len(index), 3, len(groups))
+    df = pd.DataFrame({'Observed': a[:, 0].ravel(), 'Expected': a[:, 1].ravel(), 'Population': a[:, 2].ravel()},
+            index=pd.MultiIndex.from_tuples([(name, label, g) for (name, label) in index for g in groups],
+                names=['Grouping', 'Label', 'Age Group']))
+    df['Excess'] = df['Observed'] - df['Expected']
+    df['Excess per 1M'] = df['Excess'] / df['Population'] * 1e6
+    return df
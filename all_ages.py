@@ -1,9 +1,9 @@
 #!/usr/bin/python
 
-import math, sys
+import argparse, datetime, multiprocessing, os
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
+import cdcdata, runreport, svgchart
 
 # If weighted is True, use the CDC's estimates of deaths that attempt to
 # correct for reporting delays; if False, use raw (incomplete) death figures
@@ -13,10 +13,15 @@ weighted = True
 # interval ('Upper Bound Threshold'), or as those above the expected number of
 # deaths ('Average Expected Count')
 baseline = 'Average Expected Count'
+# Baselines compared by --variants
+all_baselines = ['Average Expected Count', 'Upper Bound Threshold']
+
+# Charts are rendered by matplotlib as 'png', or directly by svgchart as 'svg'
+# or 'html', in which case the extension of their file name is replaced
+chart_format = 'png'
 
 # Calculate excess deaths since the week starting on... (must be a Sunday)
-start_date = sys.argv[1] if len(sys.argv) > 1 else '2020-04-26'
-output = sys.argv[2] if len(sys.argv) > 2 else 'e.png'
+default_start_date = '2020-04-26'
 
 # U.S. Census Bureau’s population estimates for US states and DC, as of 2019.
 # Source:
@@ -130,40 +135,125 @@ party = {
   'Wyoming': 'republican',
 }
 
-def excess_for(df, state):
-    def _excess_for(df, state):
-        if weighted:
-            df = df[df['Type'] == 'Predicted (weighted)']
-            # 'Observed Number' is adjusted to account for reporting delays
-        else:
-            df = df[df['Type'] == 'Unweighted']
-            # 'Observed Number' is the (incomplete) number of deaths
-        df = df[df['Week Ending Date'] >= start_date]
-        df = df[df['State'] == state]
-        cum_excess = 0
-        for _, row in df.iterrows():
-            o = row['Observed Number']
-            b = row[baseline]
-            # For small states, the CDC sometimes suppresses data for the last
-            # week or 2 as data is so incomplete it cannot be weighted/adjusted
-            # in which case we just skip over these states & weeks
-            if math.isnan(o):
-                continue
-            # When calculating excess deaths based on Average Expected Count,
-            # weeks may have positive or negative excess deaths. But when
-            # calculating based on the upper bound of the 95% prediction
-            # interval, we obviously only account for positive excess.
-            if baseline == 'Average Expected Count' or o - b > 0:
-                cum_excess += o - b
-        return cum_excess
+def pyplot():
+    '''Import matplotlib on first use, so that runs without charts do not
+    pay for it'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+def row_excess(df, baselines):
+    '''Return a DataFrame of the excess deaths of each row of <df> over each
+    of <baselines>'''
+    cols = {}
+    for b in baselines:
+        e = df['Observed Number'] - df[b]
+        # For small states, the CDC sometimes suppresses data for the last
+        # week or 2 as data is so incomplete it cannot be weighted/adjusted
+        # in which case we just skip over these states & weeks: the NaN excess of
+        # these weeks is ignored by sum()
+        # When calculating excess deaths based on Average Expected Count,
+        # weeks may have positive or negative excess deaths. But when
+        # calculating based on the upper bound of the 95% prediction
+        # interval, we obviously only account for positive excess.
+        if b != 'Average Expected Count':
+            e = e.where(e > 0)
+        cols[b] = e
+    return pd.DataFrame(cols)
+
+def states(df):
     # For some reason the CDC splits NY state into the city ('New York City')
     # and the rest of the state ('New York')
-    ret = _excess_for(df, state)
-    ret += _excess_for(df, 'New York City') if state == 'New York' else 0
-    return ret
+    return df['State'].astype(str).replace('New York City', 'New York')
+
+def weekly_excess(df):
+    '''Return a (state x week ending date) DataFrame of excess deaths'''
+    if weighted:
+        df = df[df['Type'] == 'Predicted (weighted)']
+        # 'Observed Number' is adjusted to account for reporting delays
+    else:
+        df = df[df['Type'] == 'Unweighted']
+        # 'Observed Number' is the (incomplete) number of deaths
+    e = row_excess(df, [baseline])[baseline]
+    return e.groupby([states(df), df['Week Ending Date']]).sum().unstack(fill_value=0)
+
+def cumulative(weekly, dates):
+    '''Return the (row x date) array of the cumulative excess deaths since
+    each of <dates> of each row of the (... x week ending date) DataFrame
+    <weekly>'''
+    # reverse cumulative sum: cum[:, i] is the excess from week i to the last
+    # week, plus a trailing column of zeros for dates past the last week
+    cum = np.cumsum(weekly.values[:, ::-1], axis=1)[:, ::-1]
+    cum = np.hstack([cum, np.zeros((len(cum), 1))])
+    # index of the first week ending on or after each date
+    idx = weekly.columns.searchsorted(pd.to_datetime(dates))
+    return cum[:, idx]
+
+def excess(df, dates):
+    '''Return a (state x start date) DataFrame of the cumulative excess
+    deaths since each of <dates>'''
+    weekly = weekly_excess(df)
+    return pd.DataFrame(cumulative(weekly, dates), index=weekly.index, columns=dates)
+
+def variants(df, dates):
+    '''Return a tidy DataFrame of the cumulative excess deaths since each of
+    <dates>, and per 1M people, of each state, for every combination of
+    Outcome, Type and baseline of <df>'''
+    # one grouped pass over all rows, summing the excess over all baselines
+    weekly = row_excess(df, all_baselines).groupby([df['Outcome'], df['Type'], states(df),
+        df['Week Ending Date']], observed=True).sum()
+    weekly.columns.name = 'Baseline'
+    # (outcome x type x state x baseline) x week ending date
+    weekly = weekly.stack().unstack('Week Ending Date', fill_value=0)
+    cum = pd.DataFrame(cumulative(weekly, dates), index=weekly.index, columns=pd.Index(dates, name='Start Date'))
+    cum = cum.stack().unstack('State')
+    # like rank(), every state in pop is included, with 0 excess if missing
+    cum = cum.reindex(columns=pop.keys(), fill_value=0)
+    cum.columns.name = 'State'
+    res = cum.stack().rename('Excess').reset_index()
+    res['Outcome'] = res['Outcome'].astype(str)
+    res['Type'] = res['Type'].astype(str)
+    res['Excess per 1M'] = res['Excess'] / res['State'].map(pop) * 1e6
+    return res[['Outcome', 'Type', 'Baseline', 'Start Date', 'State', 'Excess', 'Excess per 1M']]
+
+def slug(s):
+    '''Return <s> lowercased with runs of other characters than letters and
+    digits replaced by "-", for use in file names'''
+    return '-'.join(''.join(c if c.isalnum() else ' ' for c in s.lower()).split())
 
-def chart(res, last):
-    # res is an array of (state, excess_per_M) tuples
+def sweep_dates(specs, every):
+    '''Expand <specs>, a list of dates or FIRST..LAST ranges, into a list of
+    dates; ranges are expanded every <every> weeks'''
+    dates = []
+    for spec in specs:
+        first, _, last = spec.partition('..')
+        d = datetime.date.fromisoformat(first)
+        end = datetime.date.fromisoformat(last) if last else d
+        while d <= end:
+            dates.append(d.isoformat())
+            d += datetime.timedelta(weeks=every)
+    # ranges may overlap
+    return list(dict.fromkeys(dates))
+
+def rank(cum_excess):
+    '''Return (state, excess_per_M) tuples sorted by excess per capita'''
+    res = []
+    for st in pop.keys():
+        # calculate cumulative excess deaths per million capita
+        res.append((st, cum_excess.get(st, 0) / pop[st] * 1e6))
+    return sorted(res, key=lambda x: x[1])
+
+def output_csv(res, cum_excess, output):
+    f = open(output, 'w')
+    f.write('State,Excess,Excess per 1M\n')
+    for (st, epm) in reversed(res):
+        f.write(f'{st},{cum_excess.get(st, 0):.0f},{epm:.0f}\n')
+    f.close()
+
+def chart(res, last, start_date, output, variant=None):
+    # res is an array of (state, excess_per_M) tuples; variant, if any, is a
+    # description of the data appended to the title
     # "Tableau 20" colors
     tableau20 = [(x[0] / 255., x[1] / 255., x[2] / 255.) for x in
         [(31, 119, 180), (174, 199, 232), (255, 127, 14), (255, 187, 120),
@@ -171,9 +261,6 @@ def chart(res, last):
         (148, 103, 189), (197, 176, 213), (140, 86, 75), (196, 156, 148),
         (227, 119, 194), (247, 182, 210), (127, 127, 127), (199, 199, 199),
         (188, 189, 34), (219, 219, 141), (23, 190, 207), (158, 218, 229)]]
-    rcParams['font.family'] = ['serif']
-    rcParams['font.serif'] = ['Latin Modern Math']
-    (fig, ax) = plt.subplots(dpi=300, figsize=(6, 12))
     colors = []
     for (state, _) in res:
         if state not in party:
@@ -182,8 +269,24 @@ def chart(res, last):
             colors.append(tableau20[0])
         elif party[state] == 'republican':
             colors.append(tableau20[6])
-    ax.barh([f'{len(pop) - i}. {x[0]}' for (i, x) in enumerate(res)],
-            [_[1] for _ in res], color=colors)
+    labels = [f'{len(pop) - i}. {x[0]}' for (i, x) in enumerate(res)]
+    title = f'Cumulative Excess Deaths per Capita\nSince {start_date}' + (f'\n{variant}' if variant else '')
+    footer = ('Source: https://github.com/mbevand/excess-deaths  '
+            'Created by: Marc Bevand — @zorinaq\n'
+            'Colors represent party of state governor as of 2022-01-01 '
+            '(blue for democrat, red for republican)\n'
+            f'Excess mortality calculated from week starting {start_date} '
+            f'up to week ending {last}.\n')
+    if chart_format != 'png':
+        svgchart.write(f'{os.path.splitext(output)[0]}.{chart_format}', title, labels,
+                [_[1] for _ in res], colors, footer.rstrip(), 'Excess deaths per million people')
+        return
+    plt = pyplot()
+    rcParams = plt.rcParams
+    rcParams['font.family'] = ['serif']
+    rcParams['font.serif'] = ['Latin Modern Math']
+    (fig, ax) = plt.subplots(dpi=300, figsize=(6, 12))
+    ax.barh(labels, [_[1] for _ in res], color=colors)
     for (i, (s, e)) in enumerate(res):
         ax.text(e + 50, i - .07, f'{e:,.0f}', va='center')
     ax.set_ylim(bottom=-1, top=len(pop))
@@ -193,23 +296,64 @@ def chart(res, last):
     ax.spines['right'].set_visible(False)
     ax.tick_params(axis='y', which='both', left=False)
     ax.set_xlabel('Excess deaths per million people')
-    ax.set_title(f'Cumulative Excess Deaths per Capita\n'
-            f'Since {start_date}', fontsize='x-large', x=.35)
-    fig.text(-.09, .06,
-            'Source: https://github.com/mbevand/excess-deaths  '
-            'Created by: Marc Bevand — @zorinaq\n'
-            'Colors represent party of state governor as of 2022-01-01 '
-            '(blue for democrat, red for republican)\n'
-            f'Excess mortality calculated from week starting {start_date} '
-            f'up to week ending {last}.\n',
+    ax.set_title(title, fontsize='x-large', x=.35)
+    fig.text(-.09, .06, footer,
             va='top', ha='left',
             bbox=dict(facecolor='white', edgecolor='none'))
     fig.savefig(output, bbox_inches='tight')
+    plt.close(fig)
+
+def render(charts, jobs):
+    '''Render <charts>, a list of arguments of chart(), with <jobs> processes'''
+    # each chart is rendered by the Agg backend in its own process, which
+    # produces the same files as rendering them one after another
+    if jobs == 1 or not charts or chart_format != 'png':
+        # charts rendered without matplotlib take too little time to fork for
+        for c in charts:
+            chart(*c)
+    else:
+        # import matplotlib before forking so that it is imported once
+        pyplot()
+        with multiprocessing.Pool(min(jobs, len(charts))) as pool:
+            pool.starmap(chart, charts)
+    runreport.count('charts', len(charts))
 
 def main():
+    global chart_format
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', nargs='?', default=default_start_date,
+            help=f'calculate excess deaths since this date (default {default_start_date})')
+    parser.add_argument('output', nargs='?', default='e.png', help='chart file name')
+    parser.add_argument('--sweep', nargs='+', metavar='DATE',
+            help='calculate excess deaths since each of these dates or FIRST..LAST '
+            'ranges, and write all_ages.DATE.png and all_ages.DATE.csv for each')
+    parser.add_argument('--every', type=int, default=4, metavar='WEEKS',
+            help='step between dates of a --sweep range (default 4)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='number of processes rendering --sweep charts (default: number of CPUs)')
+    parser.add_argument('--variants', action='store_true',
+            help='calculate the excess deaths since START_DATE (or each --sweep date) of every '
+            'combination of Outcome, Type and baseline, and write them to all_ages.variants.csv')
+    parser.add_argument('--variant-charts', action='store_true',
+            help='with --variants, also write all_ages.OUTCOME.TYPE.BASELINE.DATE.png for each')
+    parser.add_argument('--no-charts', action='store_true',
+            help='only print the ranking (or with --sweep, only write the CSV files), '
+            'without loading matplotlib')
+    parser.add_argument('--format', choices=['png', 'svg', 'html'], default=chart_format,
+            help=f'format of the charts; svg and html are rendered without matplotlib (default {chart_format})')
+    parser.add_argument('--report', action='store_true',
+            help='write timings, counters and peak memory usage to all_ages.report.json')
+    parser.add_argument('--profile', action='store_true',
+            help='with --report, also write cProfile stats to all_ages.report.prof')
+    args = parser.parse_args()
+    chart_format = args.format
+    if args.report:
+        runreport.enable(profile=args.profile)
     # Excess death data. Source:
     # https://data.cdc.gov/NCHS/Excess-Deaths-Associated-with-COVID-19/xkkf-xrst/
-    df = pd.read_csv('Excess_Deaths_Associated_with_COVID-19.csv')
+    with runreport.stage('load'):
+        df = cdcdata.read_csv('Excess_Deaths_Associated_with_COVID-19.csv')
+    runreport.count('rows scanned', len(df))
     # A short description of the most important columns in the CSV file:
     # - Observed Number: observed number of deaths
     # - Upper Bound Threshold: upper bound of 95% prediction interval of
@@ -221,16 +365,50 @@ def main():
     #   (clamped to 0 if negative)
     # - Total Excess Estimate: sum of Excess Estimate for week ending 2/1/2020
     #   and later
+    if args.variants:
+        dates = sweep_dates(args.sweep, args.every) if args.sweep else [args.start_date]
+        with runreport.stage('excess'):
+            res = variants(df, dates)
+        with runreport.stage('output_csv'):
+            res.to_csv('all_ages.variants.csv', index=False, float_format='%.0f')
+        charts = []
+        if args.variant_charts:
+            last = df['Week Ending Date'].max().strftime('%Y-%m-%d')
+            for (key, v) in res.groupby(['Outcome', 'Type', 'Baseline', 'Start Date'], sort=False):
+                ranked = sorted(zip(v['State'], v['Excess per 1M']), key=lambda x: x[1])
+                charts.append((ranked, last, key[3], f'all_ages.{".".join(map(slug, key[:3]))}.{key[3]}.png',
+                    ', '.join(key[:3])))
+        with runreport.stage('chart'):
+            render(charts, args.jobs)
+        runreport.write('all_ages.report.json')
+        return
     df = df[df['Outcome'] == 'All causes']
-    res = []
-    for st in pop.keys():
-        # calculate cumulative excess deaths per million capita
-        res.append((st, excess_for(df, st) / pop[st] * 1e6))
-    res = sorted(res, key=lambda x: x[1])
-    for x in res:
-        print(f'{x[1]:.0f} {x[0]}')
     # last week with data
-    last = sorted(set(df['Week Ending Date']))[-1]
-    chart(res, last)
+    last = df['Week Ending Date'].max().strftime('%Y-%m-%d')
+    if args.sweep:
+        dates = sweep_dates(args.sweep, args.every)
+        with runreport.stage('excess'):
+            cum_excess = excess(df, dates)
+        charts = []
+        with runreport.stage('output_csv'):
+            for d in dates:
+                res = rank(cum_excess[d])
+                output_csv(res, cum_excess[d], f'all_ages.{d}.csv')
+                if not args.no_charts:
+                    charts.append((res, last, d, f'all_ages.{d}.png'))
+        with runreport.stage('chart'):
+            render(charts, args.jobs)
+    else:
+        with runreport.stage('excess'):
+            cum_excess = excess(df, [args.start_date])[args.start_date]
+        res = rank(cum_excess)
+        for x in res:
+            print(f'{x[1]:.0f} {x[0]}')
+        if not args.no_charts:
+            with runreport.stage('chart'):
+                chart(res, last, args.start_date, args.output)
+            runreport.count('charts')
+    runreport.write('all_ages.report.json')
 
-main()
+if __name__ == '__main__':
+    main()
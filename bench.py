@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# Offline benchmark of by_age_group.py and all_ages.py. It generates synthetic
+# Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv,
+# Excess_Deaths_Associated_with_COVID-19.csv and Population.csv files in the
+# schemas of the real CDC and Census Bureau files, times each stage of the
+# pipeline on them, and writes the timings and the numerical results to a JSON
+# report. Given a previous report with --compare, it flags stages that got
+# slower and results that changed. It also checks that importing the scripts
+# takes less than --import-budget seconds and does not import matplotlib, so
+# that runs without charts start quickly.
+
+import argparse, contextlib, datetime, json, os, subprocess, sys, tempfile, time
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+import cdcdata
+import by_age_group as bag
+import all_ages as aa
+
+groups = ['Under 25 years', '25-44 years', '45-64 years', '65-74 years',
+        '75-84 years', '85 years and older']
+brackets = [(0, 24), (25, 44), (45, 64), (65, 74), (75, 84), (85, 85)]
+# Share of the population, and weekly deaths per 100k people, of each group
+group_share = [.31, .26, .25, .10, .05, .02]
+group_rate = [1.2, 3.5, 13., 35., 85., 280.]
+
+def mmwr_weeks(last_year):
+    '''Return the (year, week, saturday ending it) of all MMWR weeks from 2015
+    to <last_year>'''
+    weeks = []
+    end = datetime.date(2015, 1, 10)
+    (y, w) = (2015, 1)
+    while y <= last_year:
+        weeks.append((y, w, end))
+        end += datetime.timedelta(weeks=1)
+        # the MMWR year of a week is the year of its wednesday
+        wed = end - datetime.timedelta(days=3)
+        (y, w) = (wed.year, 1) if wed.year != y else (y, w + 1)
+    return weeks
+
+def jurisdiction_names(n):
+    '''Return <n> state names (real ones first, then synthetic ones), plus the
+    United States and New York City'''
+    # New York is always included to exercise its merge with New York City
+    real = [st for st in aa.pop.keys() if st != 'New York']
+    states = ['New York'] + real + [f'Synthetic {i}' for i in range(n - 1 - len(real))]
+    return sorted(states[:n]), ['New York City', 'United States']
+
+def gen_population(rng, states):
+    '''Return Population.csv for <states>, and the total population of each'''
+    rows = []
+    total = {}
+    for (i, st) in enumerate(['United States'] + states):
+        n = 330e6 if st == 'United States' else rng.lognormal(15, 1)
+        total[st] = n
+        for sex in (0, 1, 2):
+            f = 1 if sex == 0 else .5
+            for age in list(range(86)) + [999]:
+                if age == 999:
+                    p = n * f
+                else:
+                    # spread the share of each group over its single-year ages
+                    (share, (a, b)) = next((share, (a, b))
+                            for (share, (a, b)) in zip(group_share, brackets) if a <= age <= b)
+                    p = n * f * share / (b - a + 1)
+                growth = rng.normal(1, .005, 12).cumprod()
+                rows.append(['010' if i == 0 else '040', 0 if i == 0 else 1 + i % 4,
+                    0 if i == 0 else 1 + i % 9, i, st, sex, age] +
+                    [int(p * k) for k in growth])
+    cols = ['SUMLEV', 'REGION', 'DIVISION', 'STATE', 'NAME', 'SEX', 'AGE', 'ESTBASE2010_CIV'] + \
+        [f'POPEST{y}_CIV' for y in range(2010, 2021)]
+    return pd.DataFrame(rows, columns=cols), total
+
+def gen_weekly(rng, names, total, weeks, suppressed):
+    '''Return Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'''
+    (y, w, end) = map(np.array, zip(*weeks))
+    season = 1 + .15 * np.cos(2 * np.pi * (w - 2) / 52)
+    pandemic = 1 + .2 * ((y > 2020) | ((y == 2020) & (w >= 6)))
+    trend = 1 + .01 * (y - 2015)
+    dfs = []
+    for j in names:
+        for (g, share, rate) in zip(groups, group_share, group_rate):
+            mean = total[j] * share * rate / 1e5 * season * pandemic * trend
+            for t in ('Predicted (weighted)', 'Unweighted'):
+                n = rng.poisson(mean * (1 if t == 'Predicted (weighted)' else .97)).astype(float)
+                # the CDC suppresses counts between 1 and 9, and does not publish
+                # some of these rows at all; we also suppress a share of the
+                # rows as 'highly incomplete'
+                small = n < 10
+                incomplete = rng.random(len(n)) < suppressed
+                published = ~small | (rng.random(len(n)) < .5)
+                sup = np.where(small, 'Suppressed (counts 1-9)',
+                        np.where(incomplete, 'Suppressed (counts highly incomplete, <50% of expected)', ''))
+                n[small | incomplete] = np.nan
+                dfs.append(pd.DataFrame({
+                    'Jurisdiction': j,
+                    'Week Ending Date': [e.strftime('%m/%d/%Y') for e in end],
+                    'State Abbreviation': j[:2].upper(),
+                    'Year': y,
+                    'Week': w,
+                    'Age Group': g,
+                    'Number of Deaths': n,
+                    'Time Period': np.where(y < 2020, '2015-2019', y.astype(str)),
+                    'Type': t,
+                    'Suppress': sup,
+                    'Note': '',
+                })[published])
+    return pd.concat(dfs)
+
+def gen_excess(rng, names, total, weeks):
+    '''Return Excess_Deaths_Associated_with_COVID-19.csv'''
+    weeks = [(y, w, end) for (y, w, end) in weeks if y >= 2017]
+    (y, w, end) = map(np.array, zip(*weeks))
+    dates = [e.isoformat() for e in end]
+    dfs = []
+    for st in names:
+        for t in ('Predicted (weighted)', 'Unweighted'):
+            for o in ('All causes', 'All causes, excluding COVID-19'):
+                exp = total[st] * 17 / 1e5 * (1 + .15 * np.cos(2 * np.pi * (w - 2) / 52))
+                obs = exp * rng.normal(1.15 if o == 'All causes' else 1.05, .05, len(exp))
+                # the CDC does not weight the last weeks of small states
+                obs[-2:][rng.random(2) < .3] = np.nan
+                upper = exp * 1.08
+                excess = np.clip(obs - exp, 0, None)
+                total_excess = np.nansum(excess[end >= datetime.date(2020, 2, 1)])
+                dfs.append(pd.DataFrame({
+                    'Week Ending Date': dates,
+                    'State': st,
+                    'Observed Number': obs,
+                    'Upper Bound Threshold': upper,
+                    'Exceeds Threshold': obs > upper,
+                    'Average Expected Count': exp,
+                    'Excess Estimate': excess,
+                    'Total Excess Estimate': int(total_excess),
+                    'Percent Excess Estimate': total_excess / exp.sum() * 100,
+                    'Year': y,
+                    'Type': t,
+                    'Outcome': o,
+                    'Suppress': '',
+                    'Note': '',
+                }))
+    return pd.concat(dfs)
+
+def generate(d, jurisdictions=52, last_year=2022, suppressed=.01, seed=0):
+    '''Write synthetic CSV files in directory <d>'''
+    rng = np.random.default_rng(seed)
+    (states, others) = jurisdiction_names(jurisdictions)
+    (popdf, total) = gen_population(rng, states)
+    total['New York City'] = total['New York'] * .4
+    total['New York'] -= total['New York City']
+    names = sorted(states + others)
+    popdf.to_csv(os.path.join(d, 'Population.csv'), index=False)
+    weeks = mmwr_weeks(last_year)
+    gen_weekly(rng, names, total, weeks, suppressed).to_csv(
+            os.path.join(d, 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'), index=False)
+    gen_excess(rng, names, total, weeks).to_csv(
+            os.path.join(d, 'Excess_Deaths_Associated_with_COVID-19.csv'), index=False)
+
+def timed(timings, stage, f, *args):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        t = time.perf_counter()
+        ret = f(*args)
+        timings[stage] = time.perf_counter() - t
+    print(f'{stage:20} {timings[stage]:8.3f} s')
+    return ret
+
+def import_time(tries=3):
+    '''Return the best time taken to import the scripts in a new interpreter,
+    and the plotting modules that importing them loaded'''
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import by_age_group, all_ages, service\n'
+            'print(time.perf_counter() - t)\n'
+            'print(*[m for m in ("matplotlib", "sklearn") if m in sys.modules])')
+    runs = [subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True,
+        text=True, check=True).stdout.split('\n') for _ in range(tries)]
+    return min(float(r[0]) for r in runs), runs[0][1].split()
+
+def run(render):
+    '''Run the pipeline stages in the current directory; return their timings
+    and numerical results'''
+    timings = {}
+    weekly = 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'
+    official = 'Excess_Deaths_Associated_with_COVID-19.csv'
+    timed(timings, 'load_cold', lambda: [cdcdata.read_csv(f) for f in (weekly, official)])
+    timed(timings, 'load_warm', lambda: [cdcdata.read_csv(f) for f in (weekly, official)])
+    bag.jobs = 1
+    timed(timings, 'get_all_weeks', bag.get_all_weeks)
+    timed(timings, 'parse_pop', bag.parse_pop)
+    bag.my_excess = timed(timings, 'calc_excess', bag.calc_excess)
+    bag.load_cdc_official()
+    timed(timings, 'output_csv', bag.output_csv)
+    df = cdcdata.read_csv(official)
+    df = df[df['Outcome'] == 'All causes']
+    cum_excess = timed(timings, 'excess', aa.excess, df, [aa.default_start_date])[aa.default_start_date]
+    if render:
+        timed(timings, 'render_by_age_group', bag.chart)
+        res = aa.rank(cum_excess)
+        timed(timings, 'render_all_ages', aa.chart, res, df['Week Ending Date'].max().strftime('%Y-%m-%d'),
+                aa.default_start_date, 'all_ages.png')
+    results = {
+        'by_age_group': {f'{j}/{g}': e for ((j, g), e) in bag.my_excess['Excess'].items()},
+        'all_ages': {st: float(e) for (st, e) in cum_excess.items()},
+    }
+    return timings, results
+
+def compare(report, baseline, tolerance):
+    '''Print how <report> compares to <baseline>; return False on a slowdown
+    above <tolerance> or on a change of numerical results'''
+    ok = True
+    if report['params'] != baseline['params']:
+        print(f'warning: baseline was generated with {baseline["params"]}')
+    for (stage, t) in report['timings'].items():
+        if stage not in baseline['timings']:
+            continue
+        ratio = t / baseline['timings'][stage]
+        slow = ratio > tolerance and t - baseline["timings"][stage] > .05
+        ok &= not slow
+        print(f'{stage:20} {baseline["timings"][stage]:8.3f} s -> {t:8.3f} s ({ratio:5.2f}x)'
+                f'{"  SLOWER" if slow else ""}')
+    for (script, res) in report['results'].items():
+        base = baseline['results'].get(script, {})
+        changed = [k for k in res.keys() | base.keys()
+                if k not in res or k not in base or abs(res[k] - base[k]) > .5]
+        ok &= not changed
+        print(f'{script}: {len(changed)} changed results' +
+                (f' ({", ".join(sorted(changed)[:5])}...)' if changed else ''))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jurisdictions', type=int, default=52,
+            help='number of states to generate (default 52)')
+    parser.add_argument('--last-year', type=int, default=2022,
+            help='generate weeks up to this year (default 2022)')
+    parser.add_argument('--suppressed', type=float, default=.01,
+            help='share of rows suppressed as highly incomplete (default 0.01)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-render', action='store_true', help='do not time chart rendering')
+    parser.add_argument('--output', default='bench.json', help='JSON report (default bench.json)')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare to this previous JSON report')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+            help='flag stages that got slower by more than this factor (default 1.25)')
+    parser.add_argument('--import-budget', type=float, default=1.,
+            help='fail if importing the scripts takes longer than this many seconds (default 1)')
+    args = parser.parse_args()
+    ok = True
+    (import_t, heavy) = import_time()
+    print(f'{"import":20} {import_t:8.3f} s' + (f'  imports {", ".join(heavy)}' if heavy else ''))
+    if import_t > args.import_budget or heavy:
+        print(f'import: over budget of {args.import_budget:.3f} s or imports plotting modules')
+        ok = False
+    params = {'jurisdictions': args.jurisdictions, 'last_year': args.last_year,
+            'suppressed': args.suppressed, 'seed': args.seed}
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as d:
+        t = time.perf_counter()
+        generate(d, **params)
+        print(f'{"generate":20} {time.perf_counter() - t:8.3f} s')
+        os.chdir(d)
+        try:
+            (timings, results) = run(not args.no_render)
+        finally:
+            os.chdir(cwd)
+    timings['import'] = import_t
+    report = {'params': params, 'timings': timings, 'results': results}
+    json.dump(report, open(output, 'w'), indent=1)
+    if args.compare:
+        ok &= compare(report, json.load(open(args.compare)), args.tolerance)
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
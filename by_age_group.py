@@ -1,12 +1,10 @@
 #!/usr/bin/python
 
-import os, json, time, math, datetime, sys
+import os, json, math, hashlib, argparse, multiprocessing
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
-from sklearn.linear_model import LinearRegression
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-from matplotlib import rcParams
+import cdcdata, runreport, series, svgchart, aggregate
 
 # Expected deaths for a given week can be calculated using 1 of 2 techniques:
 # 'average': average of deaths on this week through 2015-2019
@@ -20,9 +18,10 @@ predictor = 'linear_regression'
 pandemic_start_week = (2020, 6)
 
 # In Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv, CDC does not publish
-# rows for weeks which had between 0 and 10 deaths, so if we do not find some
-# of these rows, we assume 5 deaths (mean of 0-10)
-suppressed_mean = 5
+# rows for weeks which had fewer than 10 deaths, so if we do not find some of
+# these rows, we assume 4.5 deaths (mean of 0-9)
+suppressed_range = (0, 9)
+suppressed_mean = sum(suppressed_range) / 2
 
 # If we calculate the absolute excess deaths for a particular age group for a
 # particular state to be less than threshold, we ignore it and assume zero
@@ -30,14 +29,74 @@ suppressed_mean = 5
 # rows in Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv are suppressed.
 threshold = 10
 
+# Observed and expected deaths are cached in cache_file per set of model
+# parameters (predictor, pandemic_start_week, suppressed_mean) and per
+# (jurisdiction, age group) cell, along with a hash of the cell's weekly deaths,
+# so only cells whose parameters or data changed are recomputed. At most
+# cache_max_params sets of parameters are kept, the least recently used ones
+# being evicted first.
+cache_file = 'cache.by_age_group.cells.json'
+cache_max_params = 16
+
+# In incremental mode, the weekly deaths, fitted baselines and observed and
+# expected totals of each cell are saved in state_file, and the next run only
+# updates the totals for the weeks added or revised since then
+state_file = 'state.by_age_group.npz'
+incremental = False
+
+# In streaming mode, the weekly counts CSV is read in chunks of chunk_rows rows
+# that are filtered and accumulated directly into the array of deaths, instead
+# of being loaded in memory all at once
+stream = False
+chunk_rows = 100_000
+
+# Number of processes rendering charts in parallel
+jobs = os.cpu_count()
+# Number of processes analyzing cells in parallel, in shards of at least
+# min_cells_per_job cells. The real data takes milliseconds to analyze in one
+# process, much less than starting the pool, so this is only worth it for much
+# larger inputs.
+analyze_jobs = 1
+min_cells_per_job = 64
+
+# In uncertainty mode, instead of assuming suppressed_mean deaths for each
+# suppressed week, the suppressed weeks are drawn uncertainty_draws times from a
+# uniform distribution over suppressed_range deaths (of mean suppressed_mean),
+# the baselines are refit for each draw, and the percentiles
+# uncertainty_interval of the excess deaths of the draws are reported. Draws
+# are processed in batches of at most mc_batch_size (draw x cell x week)
+# elements.
+uncertainty_draws = 0
+uncertainty_interval = (2.5, 97.5)
+mc_batch_size = 1 << 24
+mc_seed = 0
+
+# If reconcile is True, the weekly observed and expected deaths of each
+# jurisdiction are compared to the CDC's by reconcile_weeks(), and the
+# reconcile_top weeks that differ most are listed. The aggregates are left out
+# of that list, as their differences are the sums of those of the states and
+# would fill it.
+reconcile = False
+reconcile_top = 20
+aggregates = ['United States']
+
+# If render is False, only print the rankings and write by_age_group.csv,
+# without importing matplotlib or rendering the charts
+render = True
+# Charts are rendered by matplotlib as 'png', or directly by svgchart as 'svg'
+# or 'html'
+chart_format = 'png'
+
 # all_weeks is an array of the MMWR weeks (yyyy, mm): [(2015, 1), (2015, 2), ...]
 # all_weeks_info maps an MMWR week (yyyy, mm) to its index in all_weeks[] and the saturday ending it:
-#   { (2015, 1): {'idx': 0, 'end': '01/10/2015'}, ... }
+#   { (2015, 1): {'idx': 0, 'end': Timestamp('2015-01-10')}, ... }
 all_weeks = []
 all_weeks_info = {}
-# my_excess contains our estimates of excess deaths; it maps an age group
-# like "75-84 years" to an array of 4-tuple:
-# (excess_per_1M, observed_deaths, expected_deaths, jurisdiction)
+# my_excess contains our estimates of excess deaths; it is a DataFrame indexed
+# by (jurisdiction, age group), where age group is like "75-84 years" or "all",
+# with columns 'Observed', 'Expected', 'Excess' and 'Excess per 1M', and in
+# uncertainty mode 'Excess low', 'Excess high', 'Excess per 1M low' and
+# 'Excess per 1M high'
 my_excess = None
 # cdc_excess maps state names to the CDC's estimate of total number of excess deaths
 cdc_excess = {}
@@ -48,7 +107,32 @@ cdc_excess = {}
 # }
 pop = {}
 
+# Index of Population.csv built by parse_pop(): pop_cum is an array indexed by
+# (jurisdiction in pop_names[], sex, vintage year in pop_years[], age) of the
+# cumulative population of single-year ages below that age, so that the
+# population of any age bracket is the difference of 2 entries. Sex is 0 for
+# both sexes, 1 for male, 2 for female. Age 85 means 85 years and older.
+pop_names = []
+pop_years = range(2010, 2021)
+pop_cum = None
+# Census (REGION, DIVISION) codes of each state in Population.csv
+pop_geo = {}
+
 highlight = None
+debugging = False
+# If set, my_excess is also saved to this file by save_results()
+results_file = None
+# If aggregate_file is set, my_excess is aggregated over the groupings of
+# jurisdictions by party of governor, census region and division, and the
+# custom groupings of groupings_file if set, and saved to this file
+aggregate_file = None
+groupings_file = None
+# If set, the weekly observed and expected deaths of every cell are saved to
+# this memory-mapped store (see series.py) by write_series()
+series_file = None
+
+# Colors of the parties in the charts: those of matplotlib's tab10(0) and tab10(3)
+party_colors = {'democrat': '#1f77b4', 'republican': '#d62728'}
 
 # Party of governors, as of 01-Jan-2022
 party = {
@@ -104,100 +188,390 @@ party = {
   'Wyoming': 'republican',
 }
 
+def pyplot():
+    '''Return matplotlib.pyplot; it is imported on first use only, as it takes
+    longer to import than the rest of the script takes to run from the caches'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
 def debug(s, end=None):
-    return
-    print(s, end=end)
+    if debugging:
+        print(s, end=end)
 
 def fmt(d):
-    '''Parse a mm/dd/yyyy date and format it yyyy-mm-dd'''
-    return datetime.datetime.strptime(d, '%m/%d/%Y').strftime('%Y-%m-%d')
+    '''Format a date yyyy-mm-dd'''
+    return d.strftime('%Y-%m-%d')
 
 def add_my(res, group, obs, exp, jurisdiction):
-    if group not in res:
-        res[group] = []
-    if jurisdiction in ('New York', 'New York City'):
+    '''Add <obs> and <exp> to the totals of (<jurisdiction>, <group>) in the
+    dict <res>'''
+    if jurisdiction == 'New York City':
         # merge "New York City" and "New York"
-        for (i, (epm2, obs2, exp2, jurisdiction2)) in enumerate(res[group]):
-            if jurisdiction2 == 'New York':
-                obs += obs2
-                exp += exp2
-                del res[group][i]
-                break
         jurisdiction = 'New York'
-    epm = (obs - exp) / pop[jurisdiction][group] * 1e6
-    res[group].append((epm, obs, exp, jurisdiction))
-
-def unsuppress(years, values):
-    years2, values2 = [], []
-    for yr in range(2015, pandemic_start_week[0]):
-        if yr in years:
-            values2.append(values.pop(0))
-        else:
-            values2.append(suppressed_mean)
-        years2.append(yr)
-    return years2, values2
+    (obs2, exp2) = res.get((jurisdiction, group), (0, 0))
+    res[(jurisdiction, group)] = (obs + obs2, exp + exp2)
 
-def expected(df, wk):
-    '''Return the expected number of deaths for week <wk>'''
-    # not all years have MMWR week # 53, so we always predict
-    # week 53 from week 52
-    y, w = wk[0], min(wk[1], 52)
-    # we calculate expected deaths using data predating the start of the pandemic
-    mask = (df['Year'] < pandemic_start_week[0]) | \
-          ((df['Year'] == pandemic_start_week[0]) & (df['Week'] < pandemic_start_week[1]))
-    mask &= df['Week'] == w
-    years = list(df[mask]['Year'])
-    values = list(df[mask]['Number of Deaths'])
-    years, values = unsuppress(years, values)
+def results_table(res, intervals=None):
+    '''Return the dict <res> built by add_my() as a DataFrame like my_excess,
+    with the intervals of excess deaths <intervals>, if any'''
+    df = pd.DataFrame([(j, g, obs, exp) for ((j, g), (obs, exp)) in res.items()],
+            columns=['Jurisdiction', 'Age Group', 'Observed', 'Expected'])
+    df = df.set_index(['Jurisdiction', 'Age Group']).sort_index()
+    df['Excess'] = df['Observed'] - df['Expected']
+    p = np.array([pop[j][g] for (j, g) in df.index])
+    df['Excess per 1M'] = df['Excess'] / p * 1e6
+    if intervals is not None:
+        df = df.join(intervals)
+        df['Excess per 1M low'] = df['Excess low'] / p * 1e6
+        df['Excess per 1M high'] = df['Excess high'] / p * 1e6
+    return df
+
+def save_results(df, path):
+    '''Save the results table <df> to <path>, as Feather, JSON or CSV
+    depending on its extension'''
+    if path.endswith('.feather'):
+        df.reset_index().to_feather(path)
+    elif path.endswith('.json'):
+        df.reset_index().to_json(path, orient='records', indent=1)
+    else:
+        df.to_csv(path)
+
+def load_results(path):
+    '''Return the results table saved by save_results() to <path>'''
+    if path.endswith('.feather'):
+        df = pd.read_feather(path)
+    elif path.endswith('.json'):
+        df = pd.read_json(path, orient='records')
+    else:
+        df = pd.read_csv(path)
+    return df.set_index(['Jurisdiction', 'Age Group'])
+
+def weighted_rows(df):
+    '''Return the rows of the weekly counts <df> that are used by the model'''
+    # keep rows that are not suppressed
+    df = df[df['Suppress'].isnull()]
+    # process number of deaths estimates, not raw (incomplete) number of deaths
+    return df[df['Type'] == 'Predicted (weighted)']
+
+def pivot(df):
+    '''Pivot the weekly counts <df> into a dense array of deaths indexed by
+    (jurisdiction, age group, index in all_weeks[]). Return the jurisdictions,
+    the age groups, the array, a (jurisdiction x age group) boolean array
+    telling which cells have at least one row, and a boolean array like the
+    array of deaths telling which weeks have no row.'''
+    jurisdictions = sorted(set(df['Jurisdiction']))
+    groups = sorted(set(df['Age Group']))
+    j = pd.Categorical(df['Jurisdiction'], categories=jurisdictions).codes
+    g = pd.Categorical(df['Age Group'], categories=groups).codes
+    w = pd.MultiIndex.from_tuples(all_weeks).get_indexer(
+            pd.MultiIndex.from_arrays([df['Year'], df['Week']]))
+    keep = w >= 0
+    # rows that are missing (suppressed) are assumed to be suppressed_mean
+    deaths = np.full((len(jurisdictions), len(groups), len(all_weeks)), float(suppressed_mean))
+    deaths[j[keep], g[keep], w[keep]] = df['Number of Deaths'][keep]
+    missing = np.ones(deaths.shape, dtype=bool)
+    missing[j[keep], g[keep], w[keep]] = False
+    present = np.zeros((len(jurisdictions), len(groups)), dtype=bool)
+    present[j, g] = True
+    return jurisdictions, groups, deaths, present, missing
+
+def stream_pivot(path, usecols):
+    '''Like pivot(weighted_rows(df)) where df is the CSV file <path>, but read
+    <path> in chunks, keeping only the columns <usecols>'''
+    weeks = pd.MultiIndex.from_tuples(all_weeks)
+    cells = {}
+    # weeks found in the file for each cell
+    found = {}
+    for df in cdcdata.iter_csv(path, usecols=usecols, chunksize=chunk_rows):
+        runreport.count('rows scanned', len(df))
+        df = weighted_rows(df)
+        w = weeks.get_indexer(pd.MultiIndex.from_arrays([df['Year'], df['Week']]))
+        n = df['Number of Deaths'].to_numpy(dtype=float)
+        for (cell, idx) in df.groupby(['Jurisdiction', 'Age Group']).indices.items():
+            if cell not in cells:
+                # rows that are missing (suppressed) are assumed to be suppressed_mean
+                cells[cell] = np.full(len(all_weeks), float(suppressed_mean))
+            idx = idx[w[idx] >= 0]
+            cells[cell][w[idx]] = n[idx]
+            found.setdefault(cell, np.zeros(len(all_weeks), dtype=bool))[w[idx]] = True
+    jurisdictions = sorted(set(j for (j, g) in cells))
+    groups = sorted(set(g for (j, g) in cells))
+    deaths = np.full((len(jurisdictions), len(groups), len(all_weeks)), float(suppressed_mean))
+    present = np.zeros((len(jurisdictions), len(groups)), dtype=bool)
+    missing = np.ones(deaths.shape, dtype=bool)
+    for ((j, g), d) in cells.items():
+        (i, k) = (jurisdictions.index(j), groups.index(g))
+        deaths[i, k] = d
+        missing[i, k] = ~found[(j, g)]
+        present[i, k] = True
+    return jurisdictions, groups, deaths, present, missing
+
+def history(deaths):
+    '''Return the (... x year x MMWR week) array of the deaths recorded on
+    weeks 1-52 of each pre-pandemic year'''
+    # not all years have MMWR week # 53, so we never train on it
+    idx = [[all_weeks_info[(y, w)]['idx'] for w in range(1, 53)]
+            for y in range(2015, pandemic_start_week[0])]
+    return deaths[..., np.array(idx)]
+
+def baselines(hist):
+    '''Fit the expected deaths of all 52 weeks at once: return the per-week
+    mean of <hist> and the slope of the per-week trend over the years'''
+    x = np.arange(2015, pandemic_start_week[0], dtype=float)
+    x -= x.mean()
+    mean = hist.mean(axis=-2)
+    runreport.count('regressions fit', mean.size)
     if predictor == 'linear_regression':
-        reg = LinearRegression().fit(np.reshape(years, (-1, 1)), np.reshape(values, (-1, 1)))
-        e = reg.predict([[y]])[0][0]
+        # closed-form least squares of all 52 weeks in one pass
+        slope = x @ (hist - mean[..., np.newaxis, :]) / (x @ x)
     elif predictor == 'average':
-        e = sum(values) / len(values)
-    debug(f' [hist: ({years}) ({values})] expecting {e} for year {y}]', end='')
-    return e
+        slope = np.zeros(mean.shape)
+    return mean, slope
 
-def analyze_group(res, df, jurisdiction, group):
-    df = df[df['Age Group'] == group]
-    df = df[['Year', 'Week', 'Number of Deaths']].sort_values(by=['Year', 'Week'])
-    total_obs = total_exp = 0
-    for i in range(all_weeks_info[pandemic_start_week]['idx'], len(all_weeks)):
-        wk = all_weeks[i]
-        debug(f'{jurisdiction} {group} processing {wk[0]}-{wk[1]} (#{i})', end='')
-        mask = (df['Year'] == wk[0]) & (df['Week'] == wk[1])
-        if not mask.any():
-            obs = suppressed_mean
+def project(mean, slope, wks):
+    '''Return the expected number of deaths for each week of <wks>, given the
+    baselines returned by baselines()'''
+    # not all years have MMWR week # 53, so we always predict
+    # week 53 from week 52
+    y = np.array([wk[0] for wk in wks], dtype=float)
+    w = np.minimum(np.array([wk[1] for wk in wks], dtype=int), 52) - 1
+    x0 = (2015 + pandemic_start_week[0] - 1) / 2
+    return mean[..., w] + slope[..., w] * (y - x0)
+
+def expected(hist, wks):
+    '''Return the expected number of deaths for each week of <wks>'''
+    return project(*baselines(hist), wks)
+
+def analyze(deaths):
+    '''Return the observed and expected deaths since the start of the pandemic
+    for each cell of <deaths>, a (... x week) array'''
+    first = all_weeks_info[pandemic_start_week]['idx']
+    obs = deaths[..., first:].sum(axis=-1)
+    exp = expected(history(deaths), all_weeks[first:]).sum(axis=-1)
+    return obs, exp
+
+def analyze_shard(name, shape, lo, hi):
+    '''Run analyze() on cells lo to hi of the array of deaths found in the
+    shared memory block <name>'''
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return analyze(np.ndarray(shape, buffer=shm.buf)[lo:hi])
+    finally:
+        shm.close()
+
+def parallel_analyze(deaths):
+    '''Like analyze(deaths) for a (cell x week) array, but shard the cells
+    across processes that read <deaths> from shared memory'''
+    n = min(analyze_jobs, len(deaths) // min_cells_per_job)
+    if n <= 1:
+        return analyze(deaths)
+    shm = shared_memory.SharedMemory(create=True, size=deaths.nbytes)
+    try:
+        np.ndarray(deaths.shape, buffer=shm.buf)[:] = deaths
+        bounds = np.linspace(0, len(deaths), n + 1).astype(int)
+        # workers are forked, so they inherit all_weeks and the model parameters
+        with multiprocessing.get_context('fork').Pool(n) as pool:
+            parts = pool.starmap(analyze_shard, [(shm.name, deaths.shape, lo, hi)
+                for (lo, hi) in zip(bounds[:-1], bounds[1:])])
+        # counters of the workers are lost with them
+        runreport.count('regressions fit', len(deaths) * 52)
+    finally:
+        shm.close()
+        shm.unlink()
+    # shards are returned in order, so the merged result is deterministic
+    return np.concatenate([o for (o, e) in parts]), np.concatenate([e for (o, e) in parts])
+
+def model_params():
+    '''Return a string identifying the model parameters that analyze() depends on'''
+    return json.dumps([predictor, pandemic_start_week, suppressed_mean])
+
+def cached_analyze(jurisdictions, groups, deaths, present):
+    '''Like analyze(deaths), but only analyze the present cells that are not
+    found in cache_file, and return zeros for the other cells'''
+    params = model_params()
+    cache = json.load(open(cache_file)) if os.path.exists(cache_file) else {}
+    # re-insert the entry at the end of the dict to mark it most recently used
+    cells = cache.pop(params, {})
+    cache[params] = cells
+    obs, exp = np.zeros(present.shape), np.zeros(present.shape)
+    todo = []
+    for (i, k) in zip(*np.nonzero(present)):
+        key = f'{jurisdictions[i]}/{groups[k]}'
+        h = hashlib.sha1(deaths[i, k].tobytes()).hexdigest()
+        if key in cells and cells[key][0] == h:
+            obs[i, k], exp[i, k] = cells[key][1:]
         else:
-            obs = float(df[mask]['Number of Deaths'])
-        exp = expected(df, wk)
-        debug(f' obs {obs} exp {exp} excess {obs-exp}')
-        total_obs += obs
-        total_exp += exp
+            todo.append((i, k, key, h))
+    runreport.count('cells cached', present.sum() - len(todo))
+    runreport.count('cells analyzed', len(todo))
+    if todo:
+        (i, k, _, _) = zip(*todo)
+        obs[i, k], exp[i, k] = parallel_analyze(deaths[i, k])
+        for (i, k, key, h) in todo:
+            cells[key] = [h, obs[i, k], exp[i, k]]
+    while len(cache) > cache_max_params:
+        del cache[next(iter(cache))]
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(cache_file + '.tmp', cache_file)
+    return obs, exp
+
+def incremental_analyze(jurisdictions, groups, deaths):
+    '''Like analyze(deaths), but start from the totals saved by the previous run
+    in state_file, and only process the weeks added or revised since then'''
+    first = all_weeks_info[pandemic_start_week]['idx']
+    weeks = np.array(all_weeks)
+    st = np.load(state_file) if os.path.exists(state_file) else None
+    n = st['deaths'].shape[-1] if st is not None else 0
+    if st is None or str(st['params']) != model_params() or \
+            list(st['jurisdictions']) != jurisdictions or list(st['groups']) != groups or \
+            not first <= n <= len(weeks) or (st['weeks'] != weeks[:n]).any():
+        print('Incremental update: no compatible previous state, analyzing all weeks')
+        mean, slope = baselines(history(deaths))
+        obs = deaths[..., first:].sum(axis=-1)
+        exp = project(mean, slope, all_weeks[first:]).sum(axis=-1)
+    else:
+        old = st['deaths']
+        mean, slope, obs, exp = st['mean'], st['slope'], st['obs'], st['exp']
+        # the baselines of cells whose pre-pandemic weeks were revised are refit
+        refit = (old[..., :first] != deaths[..., :first]).any(axis=-1)
+        if refit.any():
+            mean[refit], slope[refit] = baselines(history(deaths[refit]))
+            obs[refit] = deaths[refit, first:].sum(axis=-1)
+            exp[refit] = project(mean[refit], slope[refit], all_weeks[first:]).sum(axis=-1)
+        # revised weeks only change observed deaths
+        (j, g, w) = np.nonzero((old[..., first:] != deaths[..., first:n]) & ~refit[..., np.newaxis])
+        np.add.at(obs, (j, g), deaths[j, g, first + w] - old[j, g, first + w])
+        # new weeks
+        keep = ~refit
+        obs[keep] += deaths[keep, n:].sum(axis=-1)
+        exp[keep] += project(mean[keep], slope[keep], all_weeks[n:]).sum(axis=-1)
+        print(f'Incremental update: {len(set(w))} revised weeks, '
+                f'{len(all_weeks) - n} new weeks, {refit.sum()} refit cells')
+        runreport.count('revised weeks', len(set(w)))
+        runreport.count('new weeks', len(all_weeks) - n)
+        runreport.count('cells refit', refit.sum())
+    np.savez(state_file, params=model_params(), jurisdictions=jurisdictions,
+            groups=groups, weeks=weeks, deaths=deaths, mean=mean, slope=slope,
+            obs=obs, exp=exp)
+    return obs, exp
+
+def monte_carlo(deaths, missing):
+    '''Return the (draw x cell) array of the excess deaths of uncertainty_draws
+    draws of the <missing> weeks of <deaths>, a (cell x week) array'''
+    rng = np.random.default_rng(mc_seed)
+    n = max(1, mc_batch_size // max(1, deaths.size))
+    excess = []
+    for lo in range(0, uncertainty_draws, n):
+        d = np.repeat(deaths[np.newaxis], min(n, uncertainty_draws - lo), axis=0)
+        d[:, missing] = rng.integers(*suppressed_range, size=(len(d), missing.sum()), endpoint=True)
+        # the baselines of all draws are refit at once
+        obs, exp = analyze(d)
+        excess.append(obs - exp)
+    runreport.count('draws', uncertainty_draws)
+    return np.concatenate(excess)
+
+def excess_intervals(jurisdictions, groups, present, ok, excess):
+    '''Return the percentiles uncertainty_interval of the draws <excess>
+    returned by monte_carlo() for the <ok> cells, as a DataFrame of columns
+    'Excess low' and 'Excess high' indexed like my_excess. Cells which are
+    present but not ok are ignored like analyze_group() does.'''
+    draws = np.zeros((len(excess),) + ok.shape)
+    draws[:, ok] = excess
+    res = {}
+    for (i, k) in zip(*np.nonzero(present)):
+        add_my(res, groups[k], draws[:, i, k], 0, jurisdictions[i])
+        add_my(res, 'all', draws[:, i, k], 0, jurisdictions[i])
+    df = pd.DataFrame([(j, g, *np.percentile(e, uncertainty_interval)) for ((j, g), (e, _)) in res.items()],
+            columns=['Jurisdiction', 'Age Group', 'Excess low', 'Excess high'])
+    return df.set_index(['Jurisdiction', 'Age Group'])
+
+def write_series(jurisdictions, groups, deaths, present):
+    '''Save the observed and expected deaths of every week of every cell of
+    <deaths> to series_file; cells that are not <present> are saved as NaN'''
+    # expected deaths of all weeks, not only those since the start of the pandemic
+    exp = expected(history(deaths), all_weeks)
+    series.write(series_file, jurisdictions, groups, all_weeks,
+            [fmt(all_weeks_info[w]['end']) for w in all_weeks], deaths, exp, present)
+
+def reconcile_weeks(jurisdictions, deaths, present):
+    '''Join the weekly observed and expected deaths of each jurisdiction (all
+    age groups) since the start of the pandemic with the CDC's, and write the
+    differences to by_age_group.reconcile.csv, and the reconcile_top weeks
+    of the states that differ most to by_age_group.reconcile.top.csv'''
+    first = all_weeks_info[pandemic_start_week]['idx']
+    mask = present[..., np.newaxis]
+    obs = (deaths[..., first:] * mask).sum(axis=1)
+    exp = (expected(history(deaths), all_weeks[first:]) * mask).sum(axis=1)
+    ends = [all_weeks_info[w]['end'] for w in all_weeks[first:]]
+    # merge "New York City" and "New York" on both sides
+    names = [j if j != 'New York City' else 'New York' for j in jurisdictions]
+    ours = pd.DataFrame({'State': np.repeat(names, len(ends)), 'Week Ending Date': np.tile(ends, len(names)),
+        'Observed': obs.ravel(), 'Expected': exp.ravel()})
+    ours = ours.groupby(['State', 'Week Ending Date']).sum()
+    cdc = cdcdata.read_csv('Excess_Deaths_Associated_with_COVID-19.csv', usecols=['Week Ending Date',
+        'State', 'Observed Number', 'Average Expected Count', 'Type', 'Outcome'])
+    cdc = cdc[(cdc['Outcome'] == 'All causes') & (cdc['Type'] == 'Predicted (weighted)')]
+    cdc = cdc[cdc['Week Ending Date'] >= ends[0]]
+    states = cdc['State'].astype(str).replace('New York City', 'New York').rename('State')
+    # weeks suppressed by the CDC stay NaN
+    cdc = cdc.groupby([states, cdc['Week Ending Date']])[['Observed Number', 'Average Expected Count']].sum(min_count=1)
+    cdc.columns = ['CDC Observed', 'CDC Expected']
+    # hash join on (state, week ending date)
+    df = ours.join(cdc, how='outer')
+    print(f'Reconciliation: {len(df)} weeks, {df["Observed"].isnull().sum()} only in the CDC data, '
+            f'{df["CDC Observed"].isnull().sum()} missing or suppressed in the CDC data')
+    runreport.count('weeks reconciled', df[['Observed', 'CDC Observed']].notnull().all(axis=1).sum())
+    df['Excess'] = df['Observed'] - df['Expected']
+    df['CDC Excess'] = df['CDC Observed'] - df['CDC Expected']
+    df['Difference'] = df['Excess'] - df['CDC Excess']
+    df['Cumulative Difference'] = df.groupby(level='State')['Difference'].cumsum()
+    df.to_csv('by_age_group.reconcile.csv', float_format='%.1f', date_format='%Y-%m-%d')
+    top = df.dropna(subset=['Difference'])
+    top = top[~top.index.get_level_values('State').isin(aggregates)]
+    top = top.iloc[np.argsort(-top['Difference'].abs().to_numpy(), kind='stable')[:reconcile_top]]
+    top.to_csv('by_age_group.reconcile.top.csv', float_format='%.1f', date_format='%Y-%m-%d')
+    print(f'== Top {len(top)} weeks differing from the CDC')
+    for ((st, end), row) in top.iterrows():
+        print(f'{fmt(end)} {st:20} {row["Excess"]:7.0f} excess {row["CDC Excess"]:7.0f} CDC excess '
+                f'{row["Difference"]:+7.0f}')
+
+def analyze_group(res, jurisdiction, group, total_obs, total_exp):
+    debug(f'{jurisdiction} {group} obs {total_obs} exp {total_exp}')
     if abs(total_obs - total_exp) < threshold:
         print(f'Ignoring {jurisdiction}/{group}: {total_obs - total_exp} excess deaths')
+        runreport.count('cells under threshold')
         return 0, 0
     add_my(res, group, total_obs, total_exp, jurisdiction)
     print(f'{(total_obs / total_exp - 1) * 100:.2f}% {jurisdiction} {group} {total_obs} {total_exp}')
     return total_obs, total_exp
 
-def analyze_jurisdiction(res, df, jurisdiction):
-    df = df[df['Jurisdiction'] == jurisdiction]
+def analyze_jurisdiction(res, jurisdiction, groups, obs, exp):
     total_obs = total_exp = 0
-    for group in sorted(set(df['Age Group'])):
-        obs, exp = analyze_group(res, df, jurisdiction, group)
-        total_obs += obs
-        total_exp += exp
+    for (group, o, e) in zip(groups, obs, exp):
+        o, e = analyze_group(res, jurisdiction, group, o, e)
+        total_obs += o
+        total_exp += e
     add_my(res, 'all', total_obs, total_exp, jurisdiction)
     print(f'{total_obs - total_exp:.0f} {(total_obs / total_exp - 1) * 100:.2f}% {jurisdiction}')
 
-def get_all_weeks():
-    # Get the list of all weeks defined in the dataset
-    df = pd.read_csv('Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv',
-            usecols=['Type', 'Jurisdiction', 'Age Group', 'Week Ending Date', 'Year', 'Week'])
+def us_weeks(df):
     mask = df['Type'] == 'Predicted (weighted)'
     mask &= df['Jurisdiction'] == 'United States'
     mask &= df['Age Group'] == '85 years and older'
-    _weeks = df[mask][['Week Ending Date', 'Year', 'Week']].sort_values(by=['Year', 'Week'])
+    return df[mask][['Week Ending Date', 'Year', 'Week']]
+
+def get_all_weeks():
+    # Get the list of all weeks defined in the dataset
+    path = 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'
+    cols = ['Type', 'Jurisdiction', 'Age Group', 'Week Ending Date', 'Year', 'Week']
+    if stream:
+        _weeks = pd.concat([us_weeks(df) for df in cdcdata.iter_csv(path, usecols=cols, chunksize=chunk_rows)])
+    else:
+        _weeks = us_weeks(cdcdata.read_csv(path, usecols=cols))
+    _weeks = _weeks.sort_values(by=['Year', 'Week'])
     i = 0
     for _, row in _weeks.iterrows():
         y, w, end = row[['Year', 'Week', 'Week Ending Date']]
@@ -205,8 +579,34 @@ def get_all_weeks():
         all_weeks_info[(y, w)] = { 'idx': i, 'end': end }
         i += 1
 
+def population(jurisdiction, a, b, year=2020, sex=0):
+    '''Return the population of <jurisdiction> aged <a> to <b> (inclusive) as
+    estimated for <year>; years outside pop_years use the nearest vintage.
+    Population.csv counts everyone aged 85 and older as 85, so brackets may
+    end above 85 but not start above it.'''
+    if a > 85:
+        raise ValueError(f'age {a}: Population.csv does not break down ages above 85 (85 means 85 and older)')
+    year = min(max(year, pop_years[0]), pop_years[-1])
+    c = pop_cum[pop_names.index(jurisdiction), sex, year - pop_years[0]]
+    return int(c[min(b, 85) + 1] - c[a])
+
+def index_pop(df):
+    '''Build pop_names and pop_cum from the Population.csv DataFrame <df>'''
+    global pop_names, pop_cum, pop_geo
+    # REGION 0 is the United States as a whole
+    states = df[df['REGION'] != 0]
+    pop_geo = dict(zip(states['NAME'], zip(states['REGION'], states['DIVISION'])))
+    # AGE 999 means "any age"
+    df = df[df['AGE'] != 999]
+    pop_names = sorted(set(df['NAME']))
+    j = pd.Categorical(df['NAME'], categories=pop_names).codes
+    n = np.zeros((len(pop_names), 3, len(pop_years), 86), dtype=np.int64)
+    n[j, df['SEX'], :, df['AGE']] = df[[f'POPEST{y}_CIV' for y in pop_years]]
+    pop_cum = np.concatenate([np.zeros(n.shape[:-1] + (1,), dtype=np.int64),
+        np.cumsum(n, axis=-1)], axis=-1)
+
 def parse_pop():
-    df = pd.read_csv('Population.csv')
+    index_pop(pd.read_csv('Population.csv'))
     groups = {
             # do not use an upper bracket of 999 or higher as Population.csv
             # uses this value to mean "any age"
@@ -218,14 +618,10 @@ def parse_pop():
             '75-84 years': (75, 84),
             '85 years and older': (85, 998),
     }
-    for jurisdiction in sorted(set(df['NAME'])):
+    for jurisdiction in pop_names:
+        pop[jurisdiction] = {}
         for (group, (a, b)) in groups.items():
-            mask = (df['NAME'] == jurisdiction) & (df['SEX'] == 0) & \
-                (df['AGE'] >= a) & (df['AGE'] <= b)
-            n = int(df[mask][['POPEST2020_CIV']].sum())
-            if jurisdiction not in pop:
-                pop[jurisdiction] = {}
-            pop[jurisdiction][group] = n
+            pop[jurisdiction][group] = population(jurisdiction, a, b)
     # I could not find Puerto Rico demographics info by age group from the US
     # Census Bureau, so the data below is from
     # https://unstats.un.org/unsd/demographic-social/products/dyb/dybsets/2020.pdf
@@ -242,29 +638,107 @@ def parse_pop():
     }
 
 def init():
-    global highlight
-    if len(sys.argv) > 1:
-        highlight = sys.argv[1]
-    get_all_weeks()
-    parse_pop()
+    global highlight, incremental, stream, jobs, analyze_jobs, uncertainty_draws, reconcile, render, chart_format, \
+            debugging, results_file, series_file, aggregate_file, groupings_file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('highlight', nargs='?', help='jurisdiction to highlight in the charts')
+    parser.add_argument('--incremental', action='store_true',
+            help=f'only process the weeks added or revised since the last run (state in {state_file})')
+    parser.add_argument('--stream', action='store_true',
+            help=f'read the weekly counts CSV in chunks of {chunk_rows} rows, bypassing the cache')
+    parser.add_argument('-j', '--jobs', type=int, default=jobs,
+            help=f'number of processes rendering charts (default {jobs})')
+    parser.add_argument('--analyze-jobs', type=int, default=analyze_jobs, metavar='JOBS',
+            help=f'number of processes analyzing cells (default {analyze_jobs})')
+    parser.add_argument('--uncertainty', type=int, default=0, metavar='DRAWS',
+            help='estimate the uncertainty due to suppressed weeks with DRAWS random draws '
+            f'(reported as the {uncertainty_interval[0]}-{uncertainty_interval[1]} percentiles)')
+    parser.add_argument('--reconcile', action='store_true',
+            help='compare weekly deaths to the CDC\'s in by_age_group.reconcile.csv and '
+            'by_age_group.reconcile.top.csv')
+    parser.add_argument('--no-charts', action='store_true',
+            help='only print the rankings and write by_age_group.csv, without loading matplotlib')
+    parser.add_argument('--format', choices=['png', 'svg', 'html'], default=chart_format,
+            help=f'format of the charts; svg and html are rendered without matplotlib (default {chart_format})')
+    parser.add_argument('--report', action='store_true',
+            help='write timings, counters and peak memory usage to by_age_group.report.json')
+    parser.add_argument('--profile', action='store_true',
+            help='with --report, also write cProfile stats to by_age_group.report.prof')
+    parser.add_argument('--debug', action='store_true', help='print debugging messages')
+    parser.add_argument('--results', metavar='FILE',
+            help='also save the results table to FILE (.feather, .json or .csv)')
+    parser.add_argument('--aggregate', metavar='FILE',
+            help='also save the results aggregated by party of governor, census region and '
+            'division to FILE (.feather, .json or .csv)')
+    parser.add_argument('--groupings', metavar='JSON',
+            help='with --aggregate, also aggregate by the custom groupings of this file, like '
+            '{"Grouping": {"Label": ["Jurisdiction", ...], ...}, ...}')
+    parser.add_argument('--series', metavar='FILE',
+            help='also save the weekly observed and expected deaths of every cell to FILE')
+    args = parser.parse_args()
+    if args.report:
+        runreport.enable(profile=args.profile)
+    debugging = args.debug
+    results_file = args.results
+    series_file = args.series
+    aggregate_file = args.aggregate
+    groupings_file = args.groupings
+    highlight = args.highlight
+    incremental = args.incremental
+    stream = args.stream
+    jobs = args.jobs
+    analyze_jobs = args.analyze_jobs
+    render = not args.no_charts
+    chart_format = args.format
+    uncertainty_draws = args.uncertainty
+    reconcile = args.reconcile
+    with runreport.stage('get_all_weeks'):
+        get_all_weeks()
+    with runreport.stage('parse_pop'):
+        parse_pop()
 
 def calc_excess():
     res = {}
     # Deaths by state and by age group. Source:
     # https://data.cdc.gov/NCHS/Weekly-Counts-of-Deaths-by-Jurisdiction-and-Age/y5bj-9g5w
-    df = pd.read_csv('Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv')
-    # keep rows that are not suppressed
-    df = df[df['Suppress'].isnull()]
-    # process number of deaths estimates, not raw (incomplete) number of deaths
-    df = df[df['Type'] == 'Predicted (weighted)']
-    for jurisdiction in sorted(set(df['Jurisdiction'])):
-        analyze_jurisdiction(res, df, jurisdiction)
-    return res
+    path = 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'
+    cols = ['Jurisdiction', 'Age Group', 'Year', 'Week', 'Number of Deaths', 'Type', 'Suppress']
+    if stream:
+        with runreport.stage('stream_pivot'):
+            jurisdictions, groups, deaths, present, missing = stream_pivot(path, cols)
+    else:
+        with runreport.stage('load'):
+            df = cdcdata.read_csv(path, usecols=cols)
+        runreport.count('rows scanned', len(df))
+        with runreport.stage('pivot'):
+            jurisdictions, groups, deaths, present, missing = pivot(weighted_rows(df))
+    if series_file:
+        with runreport.stage('series'):
+            write_series(jurisdictions, groups, deaths, present)
+    if reconcile:
+        with runreport.stage('reconcile'):
+            reconcile_weeks(jurisdictions, deaths, present)
+    with runreport.stage('analyze'):
+        if incremental:
+            obs, exp = incremental_analyze(jurisdictions, groups, deaths)
+        else:
+            obs, exp = cached_analyze(jurisdictions, groups, deaths, present)
+    for (i, jurisdiction) in enumerate(jurisdictions):
+        p = present[i]
+        analyze_jurisdiction(res, jurisdiction, [g for (g, q) in zip(groups, p) if q], obs[i, p], exp[i, p])
+    intervals = None
+    if uncertainty_draws:
+        with runreport.stage('monte_carlo'):
+            # same cells as those kept by analyze_group()
+            ok = present & (np.abs(obs - exp) >= threshold)
+            excess = monte_carlo(deaths[ok], missing[ok])
+            intervals = excess_intervals(jurisdictions, groups, present, ok, excess)
+    return results_table(res, intervals)
 
 def load_cdc_official():
     # Excess death data. Source:
     # https://data.cdc.gov/NCHS/Excess-Deaths-Associated-with-COVID-19/xkkf-xrst/
-    df = pd.read_csv('Excess_Deaths_Associated_with_COVID-19.csv')
+    df = cdcdata.read_csv('Excess_Deaths_Associated_with_COVID-19.csv')
     df = df[df['Outcome'] == 'All causes']
     df = df[df['Type'] == 'Predicted (weighted)']
     for st in sorted(set(df['State'])):
@@ -279,107 +753,163 @@ def load_cdc_official():
 def chart_group(group, l):
     def colname(st):
         if st not in party: return 'black'
-        elif party[st] == 'democrat': return plt.cm.tab10(0)
-        elif party[st] == 'republican': return plt.cm.tab10(3)
+        elif party[st] in party_colors: return party_colors[party[st]]
         else: raise Exception('unknown party {party[st]}')
-    rcParams['font.family'] = ['serif']
-    rcParams['font.serif'] = ['Latin Modern Math']
-    (fig, ax) = plt.subplots(dpi=300, figsize=(6, 12))
-    ys = [_[0] for _ in l]
-    states = [f'{len(ys) - i}. ' + _[3] for (i, _) in enumerate(l)]
-    colors = list(map(colname, [_[3] for _ in l]))
-    missing = set(pop.keys()) - set([_[3] for _ in l])
+    ys = list(l['Excess per 1M'])
+    uncertainty = 'Excess per 1M low' in l
+    (lows, highs) = (list(l['Excess per 1M low']), list(l['Excess per 1M high'])) if uncertainty else (ys, ys)
+    states = [f'{len(ys) - i}. ' + j for (i, j) in enumerate(l.index)]
+    colors = list(map(colname, l.index))
+    missing = set(pop.keys()) - set(l.index)
     if missing:
         ys = [math.nan] * len(missing) + ys
+        (lows, highs) = ([math.nan] * len(missing) + lows, [math.nan] * len(missing) + highs)
         states = sorted(list(missing), reverse=True) + states
         colors = ['black'] * len(missing) + colors
+    title = f'Cumulative Excess Deaths per Capita\nFor Age Group "{group}"'
+    footer = ('Source: https://github.com/mbevand/excess-deaths  '
+            'Created by: Marc Bevand — @zorinaq\n'
+            'Colors represent party of state governor as of 2022-01-01 '
+            '(blue for democrat, red for republican)\nExcess mortality calculated '
+            f'from week ending {fmt(all_weeks_info[pandemic_start_week]["end"])} '
+            f'up to week ending {fmt(all_weeks_info[all_weeks[-1]]["end"])}' +
+            (f'\nError bars: {uncertainty_interval[0]}-{uncertainty_interval[1]} percentiles of '
+            f'{uncertainty_draws} random draws of suppressed weeks' if uncertainty else ''))
+    if chart_format != 'png':
+        svgchart.write(f'by_age_group.{group}.{chart_format}', title, states, ys, colors, footer,
+                'Excess deaths per million people', highlight=highlight,
+                errors=list(zip(lows, highs)) if uncertainty else None)
+        return
+    plt = pyplot()
+    from matplotlib import ticker, rcParams
+    rcParams['font.family'] = ['serif']
+    rcParams['font.serif'] = ['Latin Modern Math']
+    (fig, ax) = plt.subplots(dpi=300, figsize=(6, 12))
     y_pos = range(len(ys))
-    ax.barh(y_pos, ys, tick_label=states, color=colors)
-    for (i, y) in enumerate(ys):
+    # error bars span the interval of excess deaths per capita, which may not
+    # contain the estimate if the draws are skewed
+    xerr = np.clip(np.nan_to_num([np.subtract(ys, lows), np.subtract(highs, ys)]), 0, None) if uncertainty else None
+    ax.barh(y_pos, ys, tick_label=states, color=colors, xerr=xerr, ecolor='gray')
+    for (i, (y, hi)) in enumerate(zip(ys, highs)):
         if math.isnan(y):
             ax.text(0, i - .07, f'N/A (insufficient data)', va='center')
         else:
-            ax.text(max(y, 0), i - .07, f' {y:,.0f}', va='center')
+            ax.text(max(hi, 0), i - .07, f' {y:,.0f}', va='center')
     ax.set_ylim(bottom=-1, top=len(ys))
-    ax.set_xlim(left=min([0] + ys))
+    ax.set_xlim(left=min([0] + [lo for lo in lows if not math.isnan(lo)]))
     ax.tick_params(axis='y', which='both', left=False)
     ax.xaxis.set_major_formatter(ticker.FuncFormatter(lambda x, pos=None: f'{x:,.0f}'))
     ax.set_xlabel('Excess deaths per million people')
-    ax.set_title(f'Cumulative Excess Deaths per Capita\n'
-            f'For Age Group "{group}"',
-            fontsize='x-large', x=.35)
+    ax.set_title(title, fontsize='x-large', x=.35)
     for (i, jurisdiction) in enumerate(states):
         if highlight and jurisdiction.endswith(highlight):
             t = ax.get_yticklabels()[i]
             t.set_color('red')
     for sp in ax.spines:
         ax.spines[sp].set_visible(False)
-    fig.text(-.09, .06,
-            'Source: https://github.com/mbevand/excess-deaths  '
-            'Created by: Marc Bevand — @zorinaq\n'
-            'Colors represent party of state governor as of 2022-01-01 '
-            '(blue for democrat, red for republican)\nExcess mortality calculated '
-            f'from week ending {fmt(all_weeks_info[pandemic_start_week]["end"])} '
-            f'up to week ending {fmt(all_weeks_info[all_weeks[-1]]["end"])}',
+    fig.text(-.09, .06, footer,
             va='top', ha='left',
             bbox=dict(facecolor='white', edgecolor='none'))
     fig.savefig(f'by_age_group.{group}.png', bbox_inches='tight')
+    plt.close(fig)
 
 def chart():
-    for g in my_excess.keys():
-        my_excess[g].sort()
+    charts = []
+    for g in sorted(set(my_excess.index.get_level_values('Age Group'))):
+        l = my_excess.xs(g, level='Age Group').sort_values('Excess per 1M', kind='stable')
         print(f'== {g}')
-        for (epm, obs, exp, jurisdiction) in my_excess[g]:
-            print(f'{epm:5.0f} excess/1M {jurisdiction:20} {obs - exp:7.0f} excess')
-        chart_group(g, my_excess[g])
+        for (jurisdiction, epm, excess) in zip(l.index, l['Excess per 1M'], l['Excess']):
+            print(f'{epm:5.0f} excess/1M {jurisdiction:20} {excess:7.0f} excess')
+        charts.append((g, l))
+    if not render:
+        return
+    # each chart is rendered by the Agg backend in its own process, which
+    # produces the same files as rendering them one after another; charts
+    # rendered without matplotlib take too little time to fork for
+    if jobs == 1 or chart_format != 'png':
+        for (g, l) in charts:
+            chart_group(g, l)
+    else:
+        # import matplotlib before forking so that it is imported once; workers
+        # are forked, so they inherit all_weeks_info, pop and the chart options
+        pyplot()
+        with multiprocessing.get_context('fork').Pool(min(jobs, len(charts))) as pool:
+            pool.starmap(chart_group, charts)
 
 def output_csv():
     f = open('by_age_group.csv', 'w')
     f.write('Jurisdiction,Excess (CDC reference),Excess,Difference Percent,'
     'Excess Under 25,Excess 25-44,Excess 45-64,Excess 65-74,Excess 75-84,Excess 85+,'
-    'Pop Under 25,Pop 25-44,Pop 45-64,Pop 65-74,Pop 75-84,Pop 85+\n')
-    for (epm, obs, exp, jurisdiction) in sorted(my_excess['all'], key=lambda x: -cdc_excess[x[3]]):
+    'Pop Under 25,Pop 25-44,Pop 45-64,Pop 65-74,Pop 75-84,Pop 85+')
+    uncertainty = 'Excess low' in my_excess
+    if uncertainty:
+        # intervals of excess deaths are appended after the existing columns
+        for label in ('', ' Under 25', ' 25-44', ' 45-64', ' 65-74', ' 75-84', ' 85+'):
+            f.write(f',Excess{label} Low,Excess{label} High')
+    f.write('\n')
+    # (jurisdiction x age group) table of excess deaths
+    excess = my_excess['Excess'].unstack()
+    if uncertainty:
+        (low, high) = (my_excess['Excess low'].unstack(), my_excess['Excess high'].unstack())
+    for jurisdiction in sorted(excess['all'].dropna().index, key=lambda j: -cdc_excess[j]):
         cdc = cdc_excess[jurisdiction]
-        our = round(obs - exp)
+        our = round(excess.at[jurisdiction, 'all'])
         f.write(f'{jurisdiction},{cdc},{our},{((our / cdc) - 1) * 100}')
         for group in ('Under 25 years', '25-44 years', '45-64 years', '65-74 years', '75-84 years', '85 years and older'):
-            ff = list(filter(lambda x: x[3] == jurisdiction, my_excess[group]))
             f.write(',')
-            if ff:
-                _, obs, exp, _ = ff[0]
-                f.write(f'{obs - exp:.0f}')
+            if group in excess and not math.isnan(excess.at[jurisdiction, group]):
+                f.write(f'{excess.at[jurisdiction, group]:.0f}')
         for group in ('Under 25 years', '25-44 years', '45-64 years', '65-74 years', '75-84 years', '85 years and older'):
             f.write(f',{pop[jurisdiction][group]}')
+        if uncertainty:
+            for group in ('all', 'Under 25 years', '25-44 years', '45-64 years', '65-74 years', '75-84 years', '85 years and older'):
+                if group in excess and not math.isnan(excess.at[jurisdiction, group]):
+                    f.write(f',{low.at[jurisdiction, group]:.0f},{high.at[jurisdiction, group]:.0f}')
+                else:
+                    f.write(',,')
         f.write('\n')
     f.close()
 
+def groupings():
+    '''Return the groupings of jurisdictions aggregated by aggregate_results()'''
+    g = {'Governor party': aggregate.by_key(party)}
+    g.update(aggregate.census_groupings(pop_geo))
+    if groupings_file:
+        g.update(aggregate.load_groupings(groupings_file))
+    return g
+
+def aggregate_results():
+    '''Save the aggregation of my_excess over groupings() to aggregate_file'''
+    df = aggregate.aggregate(my_excess, pop, groupings())
+    save_results(df, aggregate_file)
+    runreport.count('aggregated labels', len(df) // len(set(df.index.get_level_values('Age Group'))))
+
 def overall_by_party():
+    df = aggregate.aggregate(my_excess, pop, {'party': aggregate.by_key(party)})
     for group in reversed(('Under 25 years', '25-44 years', '45-64 years', '65-74 years', '75-84 years', '85 years and older', 'all')):
         print(f'{group}: ', end='')
-        stats = { 'republican': [0, 0, 0], 'democrat': [0, 0, 0] }
-        for (epm, obs, exp, jurisdiction) in my_excess[group]:
-            if jurisdiction not in party:
-                continue
-            stats[party[jurisdiction]][0] += pop[jurisdiction][group]
-            stats[party[jurisdiction]][1] += obs
-            stats[party[jurisdiction]][2] += exp
         for p in ('republican', 'democrat'):
-            excess = stats[p][1] - stats[p][2]
-            print(f'{excess / stats[p][0] * 1e6:,.0f}{" / " if p == "republican" else ""}', end='')
+            print(f'{df.at[("party", p, group), "Excess per 1M"]:,.0f}{" / " if p == "republican" else ""}', end='')
         print()
 
 def main():
     global my_excess
     init()
-    cache = 'cache.by_age_group.json'
-    if not os.path.exists(cache) or time.time() - os.path.getmtime(cache) > 12 * 3600:
+    with runreport.stage('calc_excess'):
         my_excess = calc_excess()
-        json.dump(my_excess, open(cache, 'w'))
-    else:
-        my_excess = json.load(open(cache))
-    load_cdc_official()
-    output_csv()
+    with runreport.stage('load_cdc_official'):
+        load_cdc_official()
+    with runreport.stage('output_csv'):
+        output_csv()
+        if results_file:
+            save_results(my_excess, results_file)
+    if aggregate_file:
+        with runreport.stage('aggregate'):
+            aggregate_results()
     #overall_by_party()
-    chart()
+    with runreport.stage('chart'):
+        chart()
+    runreport.write('by_age_group.report.json')
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''Load the CDC CSV files through a columnar cache.
+
+The first time a CSV file is read, it is parsed, its dates are converted, its
+string columns are stored as categoricals, and the result is saved in Feather
+format as cache.<name>.<hash>.feather, where <hash> is a hash of the contents
+of the CSV file. Later reads of the same CSV file load the Feather file
+instead, which is much faster and needs much less memory. When the CSV file
+changes, its hash changes, and the stale Feather file is replaced.
+
+Feather files are written with pyarrow. If pyarrow is not installed, CSV
+files are parsed every time.'''
+
+import glob, hashlib, os
+import pandas as pd
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Columns containing dates, and their format, in each CSV file
+date_columns = {
+    'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv': {'Week Ending Date': '%m/%d/%Y'},
+    'Excess_Deaths_Associated_with_COVID-19.csv': {'Week Ending Date': '%Y-%m-%d'},
+}
+
+# Digests computed by file_hash(), keyed on (path, modification time, size), so
+# that a file read several times per run is hashed once
+digests = {}
+
+def file_hash(path):
+    '''Return the hex digest of the SHA-1 hash of the contents of <path>'''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if key not in digests:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digests[key] = h.hexdigest()
+    return digests[key]
+
+def parse_dates(df, path):
+    '''Convert the date columns of <df>, read from the CSV file <path>'''
+    for (col, fmt) in date_columns.get(os.path.basename(path), {}).items():
+        if col in df:
+            df[col] = pd.to_datetime(df[col], format=fmt)
+
+def parse(path):
+    '''Parse the CSV file <path> into a DataFrame of compact types'''
+    df = pd.read_csv(path)
+    parse_dates(df, path)
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df
+
+def read_csv(path, usecols=None):
+    '''Return the contents of the CSV file <path> (only the columns <usecols>
+    if specified) as a DataFrame'''
+    if pyarrow is None:
+        df = parse(path)
+        return df[usecols] if usecols else df
+    d, name = os.path.split(path)
+    stem = os.path.splitext(name)[0]
+    cache = os.path.join(d, f'cache.{stem}.{file_hash(path)}.feather')
+    if not os.path.exists(cache):
+        for stale in glob.glob(os.path.join(glob.escape(d), f'cache.{glob.escape(stem)}.*.feather')):
+            os.remove(stale)
+        # write to a temporary file first so that a concurrent or interrupted
+        # run never sees a partial cache
+        parse(path).to_feather(cache + '.tmp')
+        os.replace(cache + '.tmp', cache)
+    return pd.read_feather(cache, columns=usecols)
+
+def iter_csv(path, usecols=None, chunksize=100_000):
+    '''Yield the contents of the CSV file <path> (only the columns <usecols>
+    if specified) as DataFrames of at most <chunksize> rows, without going
+    through the cache, so that memory usage does not grow with the file'''
+    for df in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+        parse_dates(df, path)
+        yield df
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Download files only if they changed since the last download.
+#
+# usage: fetch.py URL FILE [URL FILE ...]
+#
+# The ETag, Last-Modified date and SHA-1 hash of each downloaded FILE are
+# saved in FILE.fetch.json. The next download sends them back to the server
+# (If-None-Match and If-Modified-Since headers) so that an unchanged file is
+# not downloaded again. Files are downloaded to FILE.part and atomically
+# renamed to FILE when complete. An interrupted download is resumed from where
+# it stopped (Range and If-Range headers) if the server supports it. A file
+# downloaded again whose content hash did not change is left untouched.
+#
+# Exits with status 0 if any FILE changed, 3 if none changed, 1 on error.
+
+import json, os, sys, hashlib, urllib.request, urllib.error
+
+unchanged_status = 3
+
+def load_meta(path):
+    try:
+        return json.load(open(path))
+    except (OSError, ValueError):
+        return {}
+
+def save_meta(path, meta):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def validators(resp):
+    '''Return the ETag and Last-Modified headers of the response <resp>'''
+    return {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+
+def fetch(url, path):
+    '''Download <url> to <path> if it changed; return True if <path> changed'''
+    meta = load_meta(path + '.fetch.json') if os.path.exists(path) else {}
+    part = path + '.part'
+    part_meta = load_meta(part + '.json')
+    req = urllib.request.Request(url)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset and (part_meta.get('etag') or part_meta.get('last_modified')):
+        # resume the interrupted download, unless the file changed since
+        req.add_header('Range', f'bytes={offset}-')
+        req.add_header('If-Range', part_meta.get('etag') or part_meta['last_modified'])
+    else:
+        offset = 0
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        resp = urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print(f'{path}: not modified')
+            return False
+        raise
+    with resp:
+        if resp.status != 206:
+            # the server sent the whole file
+            offset = 0
+            part_meta = validators(resp)
+            save_meta(part + '.json', part_meta)
+        length = resp.headers.get('Content-Length')
+        with open(part, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            for block in iter(lambda: resp.read(1 << 20), b''):
+                f.write(block)
+            received = f.tell() - offset
+    if length is not None and received != int(length):
+        # keep the partial file to resume from it next time
+        raise OSError(f'{url}: connection closed after {received} of {length} bytes')
+    h = file_hash(part)
+    changed = not os.path.exists(path) or h != meta.get('sha1')
+    if changed:
+        os.replace(part, path)
+    else:
+        os.remove(part)
+    os.remove(part + '.json')
+    save_meta(path + '.fetch.json', dict(part_meta, sha1=h))
+    print(f'{path}: {"downloaded" if changed else "content unchanged"}')
+    return changed
+
+def main():
+    args = sys.argv[1:]
+    if not args or len(args) % 2:
+        print('usage: fetch.py URL FILE [URL FILE ...]', file=sys.stderr)
+        sys.exit(1)
+    changed = False
+    for (url, path) in zip(args[::2], args[1::2]):
+        changed |= fetch(url, path)
+    sys.exit(0 if changed else unchanged_status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''Instrumentation of the pipeline: per-stage timers, counters, peak memory
+usage and an optional cProfile dump, written to a JSON run report.
+
+Timers and counters are always collected, as they are cheap; the report is
+only written if enable() was called.'''
+
+import contextlib, cProfile, datetime, json, resource, sys, time
+from collections import Counter
+
+enabled = False
+profiler = None
+started = None
+# Seconds spent in each stage, and named counters, e.g. 'rows scanned'
+timings = {}
+counters = Counter()
+
+def enable(profile=False):
+    '''Enable writing the run report, and profiling the run with cProfile if
+    <profile> is true'''
+    global enabled, profiler, started
+    enabled = True
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+@contextlib.contextmanager
+def stage(name):
+    '''Time the code run in this context as stage <name>'''
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - t
+
+def count(name, n=1):
+    counters[name] += int(n)
+
+def write(path):
+    '''Write the run report to <path>, and the cProfile stats, if any, to the
+    same path with a .prof extension'''
+    if not enabled:
+        return
+    prof = None
+    if profiler:
+        profiler.disable()
+        prof = path.rsplit('.', 1)[0] + '.prof'
+        profiler.dump_stats(prof)
+    report = {
+        'argv': sys.argv,
+        'started': started,
+        'timings': timings,
+        'counters': counters,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'profile': prof,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
@@ -0,0 +1,93 @@
+'''Memory-mapped store of the weekly observed, expected and excess deaths of
+each (jurisdiction, age group) cell.
+
+A store is a single file: a magic line, the length of a JSON header, the JSON
+header (jurisdictions, age groups, MMWR weeks and their end dates, and the
+offset and shape of each array), then the float64 arrays, each aligned on
+a page boundary. load() maps the arrays read-only without copying them into
+memory, so any window can be sliced from a large store.
+
+The arrays are:
+- obs, exp, excess: indexed by (jurisdiction, age group, week), so that the
+  series of a cell is contiguous
+- cum_obs, cum_exp, cum_excess: the cumulative sums of the former over the
+  weeks, indexed by (week, jurisdiction, age group) and starting with a row of
+  zeros, so that the totals of all cells over any range of weeks are the
+  difference of 2 contiguous rows
+
+Deaths are stored per jurisdiction as found in the CDC file ("New York City"
+is not merged into "New York") and before applying by_age_group.threshold.
+Cells of which the CDC file has no row at all are stored as NaN, and are false
+in the (jurisdiction x age group) boolean array "present" of the header.'''
+
+import json, os, struct
+import numpy as np
+
+magic = b'excess-deaths series 1\n'
+align = 4096
+
+def write(path, jurisdictions, groups, weeks, ends, obs, exp, present):
+    '''Write the (jurisdiction x age group x week) arrays <obs> and <exp> to
+    the store <path>, with NaN for the cells that are not <present>; <weeks>
+    are the (year, week) MMWR weeks and <ends> the yyyy-mm-dd dates ending
+    them'''
+    absent = ~present[..., np.newaxis]
+    (obs, exp) = (np.where(absent, np.nan, obs), np.where(absent, np.nan, exp))
+    excess = obs - exp
+    arrays = {'obs': obs, 'exp': exp, 'excess': excess}
+    for (name, a) in list(arrays.items()):
+        cum = np.zeros((a.shape[-1] + 1,) + a.shape[:-1])
+        np.cumsum(np.moveaxis(a, -1, 0), axis=0, out=cum[1:])
+        arrays['cum_' + name] = cum
+    layout = {}
+    offset = 0
+    for (name, a) in arrays.items():
+        layout[name] = {'offset': offset, 'shape': a.shape}
+        offset += -(-a.nbytes // align) * align
+    header = json.dumps({
+        'jurisdictions': list(jurisdictions),
+        'groups': list(groups),
+        'weeks': [list(map(int, w)) for w in weeks],
+        'ends': list(ends),
+        'present': present.tolist(),
+        'arrays': layout,
+    }).encode()
+    start = -(-(len(magic) + 8 + len(header)) // align) * align
+    with open(path + '.tmp', 'wb') as f:
+        f.write(magic + struct.pack('<Q', len(header)) + header)
+        for (name, a) in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            np.ascontiguousarray(a, dtype='<f8').tofile(f)
+    os.replace(path + '.tmp', path)
+
+def load(path):
+    '''Return the store <path> as a dict of its header fields and of its
+    read-only memory-mapped arrays'''
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path}: not a series store')
+        (n,) = struct.unpack('<Q', f.read(8))
+        store = json.loads(f.read(n))
+    start = -(-(len(magic) + 8 + n) // align) * align
+    for (name, a) in store.pop('arrays').items():
+        store[name] = np.memmap(path, dtype='<f8', mode='r', offset=start + a['offset'],
+                shape=tuple(a['shape']))
+    store['weeks'] = [tuple(w) for w in store['weeks']]
+    store['present'] = np.array(store['present'], dtype=bool)
+    return store
+
+def week_range(store, since=None, until=None):
+    '''Return the range of indices of the weeks of <store> ending on or after
+    <since> and on or before <until> (yyyy-mm-dd dates, or None for no
+    bound)'''
+    ends = np.array(store['ends'])
+    lo = 0 if since is None else ends.searchsorted(since, 'left')
+    hi = len(ends) if until is None else ends.searchsorted(until, 'right')
+    return int(lo), int(hi)
+
+def totals(store, name, since=None, until=None):
+    '''Return the (jurisdiction x age group) array of the totals of <name>
+    ('obs', 'exp' or 'excess') over the weeks selected by week_range()'''
+    (lo, hi) = week_range(store, since, until)
+    cum = store['cum_' + name]
+    return cum[max(hi, lo)] - cum[lo]
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+# Resident query service over the models of by_age_group.py and all_ages.py.
+#
+# usage: service.py [--host HOST] [--port PORT]
+#
+# The CSV files are loaded and the model is fitted once, at startup. The
+# observed and expected deaths of every (jurisdiction, age group, week) cell,
+# and the CDC's excess deaths of every (state, week) cell, are kept in memory
+# as cumulative sums over the weeks, so that the totals of any range of weeks
+# are answered without going through the data again. The CSV files are polled
+# every poll_interval seconds, and reloaded when they change; queries are
+# answered from the previous data until the reload completes.
+#
+# Queries (GET, answered in JSON):
+#   /info
+#       jurisdictions, age groups and weeks available
+#   /excess?jurisdiction=Ohio&group=65-74 years[&since=DATE][&until=DATE]
+#       observed, expected and excess deaths, and excess deaths per 1M people,
+#       of a jurisdiction and age group (or "all")
+#   /ranking?group=45-64 years[&since=DATE][&until=DATE]
+#       the same for all jurisdictions, ranked by excess deaths per 1M people
+#   /all_ages[?since=DATE][&until=DATE]
+#       states ranked by the CDC's excess deaths per 1M people, like all_ages.py
+#
+# DATE is yyyy-mm-dd; the weeks ending on or after <since> and on or before
+# <until> are counted. By default, by_age_group.py's model counts weeks since
+# the start of the pandemic, and all_ages.py's model since its default start
+# date, up to the last week.
+
+import argparse, json, os, sys, threading, time, traceback, urllib.parse
+import http.server
+import numpy as np
+import pandas as pd
+import cdcdata
+import by_age_group as bag
+import all_ages as aa
+
+weekly_file = 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'
+excess_file = 'Excess_Deaths_Associated_with_COVID-19.csv'
+pop_file = 'Population.csv'
+poll_interval = 5
+
+# The loaded data, replaced as a whole by reload() so that queries running
+# concurrently always see consistent data
+model = None
+
+def stamps():
+    '''Return the modification time and size of the input files'''
+    return [(os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in (weekly_file, excess_file, pop_file)]
+
+def load():
+    '''Load the CSV files and fit by_age_group.py's model; return the data
+    needed to answer queries'''
+    st = stamps()
+    bag.all_weeks.clear()
+    bag.all_weeks_info.clear()
+    bag.pop.clear()
+    bag.get_all_weeks()
+    bag.parse_pop()
+    cols = ['Jurisdiction', 'Age Group', 'Year', 'Week', 'Number of Deaths', 'Type', 'Suppress']
+    jurisdictions, groups, deaths, present, _ = bag.pivot(bag.weighted_rows(cdcdata.read_csv(weekly_file, usecols=cols)))
+    # expected deaths of all weeks, not only those since the start of the pandemic
+    exp = bag.expected(bag.history(deaths), bag.all_weeks)
+    def cum(a):
+        return np.concatenate([np.zeros(a.shape[:-1] + (1,)), np.cumsum(a, axis=-1)], axis=-1)
+    # "New York City" is merged into "New York" after applying the threshold
+    # to each, like by_age_group.py does
+    names = sorted(set(j if j != 'New York City' else 'New York' for j in jurisdictions))
+    merge = np.array([names.index(j if j != 'New York City' else 'New York') for j in jurisdictions])
+    population = np.array([[bag.pop.get(j, {}).get(g, np.nan) for g in groups + ['all']] for j in names], dtype=float)
+    df = cdcdata.read_csv(excess_file)
+    weekly = aa.weekly_excess(df[df['Outcome'] == 'All causes'])
+    return {
+        'stamps': st,
+        'jurisdictions': jurisdictions,
+        'groups': groups,
+        'names': names,
+        'merge': merge,
+        'present': present,
+        'ends': pd.DatetimeIndex([bag.all_weeks_info[w]['end'] for w in bag.all_weeks]),
+        'start': bag.all_weeks_info[bag.pandemic_start_week]['end'],
+        'cum_obs': cum(deaths),
+        'cum_exp': cum(exp),
+        'population': population,
+        'states': list(weekly.index),
+        'cdc_ends': weekly.columns,
+        'cdc_cum': cum(weekly.values),
+    }
+
+def reload():
+    global model
+    t = time.perf_counter()
+    model = load()
+    print(f'Loaded {len(model["jurisdictions"])} jurisdictions, {len(model["ends"])} weeks '
+            f'in {time.perf_counter() - t:.1f} s', file=sys.stderr)
+
+def watch():
+    '''Reload the data whenever the input files change'''
+    while True:
+        time.sleep(poll_interval)
+        try:
+            if stamps() != model['stamps']:
+                reload()
+        except Exception:
+            # keep answering from the previous data, e.g. if a file is
+            # being replaced
+            traceback.print_exc()
+
+def week_range(ends, q, default_since):
+    '''Return the range of indices of <ends> selected by the since and until
+    parameters of the query <q>; the range is empty if <until> is before
+    <since>'''
+    since = pd.Timestamp(q.get('since', default_since))
+    until = pd.Timestamp(q['until']) if 'until' in q else ends[-1]
+    (lo, hi) = (ends.searchsorted(since, 'left'), ends.searchsorted(until, 'right'))
+    return lo, max(hi, lo)
+
+def totals(m, lo, hi):
+    '''Return the (jurisdiction x age group) arrays of observed and expected
+    deaths of weeks lo to hi, for the jurisdictions in m['names'] and the age
+    groups in m['groups'] + ['all'], and the boolean array of cells that are
+    not ignored'''
+    obs = m['cum_obs'][..., hi] - m['cum_obs'][..., lo]
+    exp = m['cum_exp'][..., hi] - m['cum_exp'][..., lo]
+    ok = m['present'] & (np.abs(obs - exp) >= bag.threshold)
+    (obs, exp) = (np.where(ok, obs, 0), np.where(ok, exp, 0))
+    shape = (len(m['names']), len(m['groups']))
+    (mobs, mexp, mok) = (np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=bool))
+    np.add.at(mobs, m['merge'], obs)
+    np.add.at(mexp, m['merge'], exp)
+    np.logical_or.at(mok, m['merge'], ok)
+    mpresent = np.zeros(len(m['names']), dtype=bool)
+    np.logical_or.at(mpresent, m['merge'], m['present'].any(axis=-1))
+    return (np.column_stack([mobs, mobs.sum(axis=-1)]), np.column_stack([mexp, mexp.sum(axis=-1)]),
+            np.column_stack([mok, mpresent]))
+
+def cell(m, obs, exp, i, k):
+    excess = obs[i, k] - exp[i, k]
+    per_1m = excess / m['population'][i, k] * 1e6
+    return {
+        'jurisdiction': m['names'][i],
+        'group': (m['groups'] + ['all'])[k],
+        'observed': obs[i, k],
+        'expected': exp[i, k],
+        'excess': excess,
+        'excess_per_1M': None if np.isnan(per_1m) else per_1m,
+    }
+
+def query_info(m, q):
+    return {
+        'jurisdictions': m['names'],
+        'groups': m['groups'] + ['all'],
+        'first_week': bag.fmt(m['ends'][0]),
+        'last_week': bag.fmt(m['ends'][-1]),
+        'pandemic_start': bag.fmt(m['start']),
+    }
+
+def query_excess(m, q):
+    (lo, hi) = week_range(m['ends'], q, m['start'])
+    (obs, exp, ok) = totals(m, lo, hi)
+    try:
+        i = m['names'].index(q['jurisdiction'])
+        k = (m['groups'] + ['all']).index(q.get('group', 'all'))
+    except ValueError as e:
+        raise KeyError(str(e))
+    return dict(cell(m, obs, exp, i, k), weeks=int(hi - lo),
+            ignored=not ok[i, k])
+
+def query_ranking(m, q):
+    (lo, hi) = week_range(m['ends'], q, m['start'])
+    (obs, exp, ok) = totals(m, lo, hi)
+    try:
+        k = (m['groups'] + ['all']).index(q.get('group', 'all'))
+    except ValueError as e:
+        raise KeyError(str(e))
+    res = [cell(m, obs, exp, i, k) for i in np.nonzero(ok[:, k])[0]]
+    res.sort(key=lambda c: -np.inf if c['excess_per_1M'] is None else c['excess_per_1M'], reverse=True)
+    return {'weeks': int(hi - lo), 'ranking': res,
+            'ignored': [m['names'][i] for i in np.nonzero(~ok[:, k])[0]]}
+
+def query_all_ages(m, q):
+    (lo, hi) = week_range(m['cdc_ends'], q, aa.default_start_date)
+    excess = m['cdc_cum'][:, hi] - m['cdc_cum'][:, lo]
+    cum_excess = dict(zip(m['states'], excess))
+    res = [{'state': st, 'excess': cum_excess.get(st, 0), 'excess_per_1M': epm}
+            for (st, epm) in reversed(aa.rank(cum_excess))]
+    return {'weeks': int(hi - lo), 'ranking': res}
+
+queries = {
+    '/info': query_info,
+    '/excess': query_excess,
+    '/ranking': query_ranking,
+    '/all_ages': query_all_ages,
+}
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        q = dict(urllib.parse.parse_qsl(url.query))
+        if url.path not in queries:
+            return self.reply(404, {'error': f'unknown query {url.path}'})
+        try:
+            self.reply(200, queries[url.path](model, q))
+        except KeyError as e:
+            self.reply(400, {'error': f'missing or unknown parameter: {e}'})
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+
+    def reply(self, status, body):
+        data = json.dumps(body, default=float).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def main():
+    global poll_interval
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default 8000)')
+    parser.add_argument('--poll', type=float, default=poll_interval,
+            help=f'check for changed CSV files every this many seconds (default {poll_interval})')
+    args = parser.parse_args()
+    poll_interval = args.poll
+    bag.jobs = 1
+    reload()
+    threading.Thread(target=watch, daemon=True).start()
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f'Listening on http://{args.host}:{args.port}/', file=sys.stderr)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
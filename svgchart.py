@@ -0,0 +1,99 @@
+'''Render the ranked horizontal bar charts of by_age_group.py and all_ages.py
+directly as SVG, or as a self-contained HTML page embedding the SVG, without
+matplotlib.
+
+The layout follows the matplotlib charts: title at the top, one bar per
+jurisdiction with its rank and name on the left and its value on the right,
+"N/A" rows for missing values, an x axis labelled at the bottom, and a footer.
+Hovering a bar shows its exact value.'''
+
+import math
+from xml.sax.saxutils import escape
+
+width = 600
+row_height = 18
+# widths of the labels on the left of the bars and of the values on their right
+label_width = 170
+value_width = 70
+font = 'font-family="Latin Modern Math, serif"'
+
+def ticks(lo, hi, n=6):
+    '''Return round tick values covering <lo> to <hi>, about <n> of them'''
+    if hi <= lo:
+        return [lo]
+    step = 10 ** math.floor(math.log10((hi - lo) / n))
+    for k in (1, 2, 5, 10):
+        if (hi - lo) / (step * k) <= n:
+            step *= k
+            break
+    return [i * step for i in range(math.floor(lo / step), math.ceil(hi / step) + 1)]
+
+def svg(title, labels, values, colors, footer, xlabel, highlight=None, errors=None,
+        na_text='N/A (insufficient data)'):
+    '''Return the SVG of a chart of bars of <values> labelled <labels>, both
+    ordered from the bottom bar to the top one like in matplotlib's barh(),
+    of <colors> (any SVG color, or a tuple of RGB values from 0 to 1). NaN
+    values are drawn as <na_text>. Labels ending with <highlight> are drawn in
+    red. <errors>, if any, are the (low, high) values of the error bars.'''
+    def color(c):
+        return c if isinstance(c, str) else '#' + ''.join(f'{round(x * 255):02x}' for x in c[:3])
+    known = [v for v in values if not math.isnan(v)]
+    if errors:
+        known += [e for lh in errors for e in lh if not math.isnan(e)]
+    xt = ticks(min([0] + known), max([0] + known))
+    (x0, x1) = (xt[0], xt[-1])
+    plot = width - label_width - value_width
+    def x(v):
+        return label_width + (v - x0) / ((x1 - x0) or 1) * plot
+    title_lines = title.split('\n')
+    top = 20 + 24 * len(title_lines)
+    n = len(values)
+    axis = top + n * row_height + 6
+    footer_lines = footer.split('\n')
+    height = axis + 50 + 14 * len(footer_lines)
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}" {font} font-size="11">',
+            f'<rect width="{width}" height="{height}" fill="white"/>']
+    for (i, t) in enumerate(title_lines):
+        out.append(f'<text x="{width * .45:.0f}" y="{26 + 24 * i}" font-size="18" '
+                f'text-anchor="middle">{escape(t)}</text>')
+    for (i, (label, v, c)) in enumerate(reversed(list(zip(labels, values, colors)))):
+        y = top + i * row_height
+        mid = y + row_height / 2 + 4
+        red = ' fill="red"' if highlight and label.endswith(highlight) else ''
+        out.append(f'<text x="{label_width - 4}" y="{mid:.1f}" text-anchor="end"{red}>{escape(label)}</text>')
+        if math.isnan(v):
+            out.append(f'<text x="{x(0) + 2:.1f}" y="{mid:.1f}">{escape(na_text)}</text>')
+            continue
+        (a, b) = sorted((x(0), x(v)))
+        out.append(f'<rect class="bar" x="{a:.1f}" y="{y + 2}" width="{b - a:.1f}" height="{row_height - 4}" '
+                f'fill="{color(c)}"><title>{escape(label)}: {v:,.0f}</title></rect>')
+        end = v
+        if errors:
+            (lo, hi) = errors[n - 1 - i]
+            if not math.isnan(lo):
+                out.append(f'<path d="M{x(lo):.1f} {y + row_height / 2:.1f}H{x(hi):.1f}" stroke="gray"/>')
+                end = max(end, hi)
+        out.append(f'<text x="{x(max(end, 0)) + 3:.1f}" y="{mid:.1f}">{v:,.0f}</text>')
+    out.append(f'<path d="M{label_width} {axis}H{width - value_width}" stroke="black" stroke-width=".5"/>')
+    for t in xt:
+        out.append(f'<path d="M{x(t):.1f} {axis}v4" stroke="black" stroke-width=".5"/>'
+                f'<text x="{x(t):.1f}" y="{axis + 16}" text-anchor="middle">{t:,.0f}</text>')
+    out.append(f'<text x="{label_width + plot / 2:.0f}" y="{axis + 32}" font-size="12" '
+            f'text-anchor="middle">{escape(xlabel)}</text>')
+    for (i, t) in enumerate(footer_lines):
+        out.append(f'<text x="4" y="{axis + 54 + 14 * i}" font-size="10">{escape(t)}</text>')
+    out.append('</svg>')
+    return '\n'.join(out)
+
+def write(path, title, *args, **kwargs):
+    '''Write the chart returned by svg(title, ...) to <path>, as an HTML page
+    if <path> ends with .html, or as SVG otherwise'''
+    s = svg(title, *args, **kwargs)
+    if path.endswith('.html'):
+        s = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                f'<title>{escape(title.replace(chr(10), " "))}</title>'
+                '<style>.bar:hover{opacity:.7}</style></head><body>\n'
+                f'{s}\n</body></html>\n')
+    with open(path, 'w') as f:
+        f.write(s)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+# Compare settings of by_age_group.py's model: predictor, first year of the
+# training window, pandemic_start_week, suppressed_mean and threshold.
+#
+# The weekly counts are read once, and the regression sufficient statistics
+# (n, Σx, Σy, Σxy, Σx²) of every (jurisdiction, age group, MMWR week) are
+# precomputed as cumulative sums over the years, so that the baselines of any
+# training window are fitted in constant time per cell. Suppressed weeks are
+# accounted for separately (their number and Σx), so that any suppressed_mean
+# is applied without going through the data again.
+#
+# For every configuration, a holdout backtest trains the baselines on
+# 2015-2018 (or from the first training year to 2018), predicts the deaths of
+# each week of 2019 of every jurisdiction and age group, and scores the
+# predictions. The excess deaths since pandemic_start_week are also
+# calculated. The results are printed and written to a CSV table with one row
+# per configuration and age group.
+
+import argparse, itertools
+import numpy as np
+import pandas as pd
+import cdcdata
+import by_age_group as bag
+
+backtest_year = 2019
+# "United States" is the sum of the other jurisdictions, so it is left out of
+# the scores and of the total excess deaths
+aggregates = ['United States']
+
+def stats(deaths, missing, years):
+    '''Return the cumulative sums over <years> of Σy, Σxy, the number of
+    suppressed weeks and their Σx, as an array indexed by (year index + 1,
+    jurisdiction, age group, MMWR week - 1, statistic). x is the year minus
+    2015, and y the deaths, counting suppressed weeks as zero.'''
+    idx = np.array([[bag.all_weeks_info[(y, w)]['idx'] for w in range(1, 53)] for y in years])
+    y0 = np.where(missing, 0, deaths)[..., idx]
+    m = missing[..., idx].astype(float)
+    x = (np.array(years) - 2015.)[:, np.newaxis]
+    s = np.stack([y0, x * y0, m, x * m], axis=-1)
+    # (jurisdiction, age group, year, week, statistic) -> (year, ...)
+    s = np.moveaxis(s, 2, 0)
+    return np.concatenate([np.zeros((1,) + s.shape[1:]), np.cumsum(s, axis=0)])
+
+def fit(cum, years, first, last, predictor, suppressed_mean):
+    '''Return the intercept (at x = 0) and slope of the baselines of all cells
+    and MMWR weeks, trained on years <first> to <last>'''
+    (sy0, sxy0, sm, smx) = np.moveaxis(cum[years.index(last) + 1] - cum[years.index(first)], -1, 0)
+    x = np.arange(first, last + 1) - 2015.
+    (n, sx, sxx) = (len(x), x.sum(), (x * x).sum())
+    sy = sy0 + suppressed_mean * sm
+    sxy = sxy0 + suppressed_mean * smx
+    if predictor == 'linear_regression':
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    elif predictor == 'average':
+        slope = np.zeros(sy.shape)
+    return (sy - slope * sx) / n, slope
+
+def week_weights(wks):
+    '''Return the number of weeks of <wks> predicted from each MMWR week, and
+    the sum of their x'''
+    count, sx = np.zeros(52), np.zeros(52)
+    for (y, w) in wks:
+        # week 53 is predicted from week 52
+        count[min(w, 52) - 1] += 1
+        sx[min(w, 52) - 1] += y - 2015
+    return count, sx
+
+def backtest(cum, years, deaths, missing, first, predictor, suppressed_mean):
+    '''Return the (jurisdiction x age group x week) arrays of predicted and
+    actual deaths of each week of backtest_year'''
+    (a, b) = fit(cum, years, first, backtest_year - 1, predictor, suppressed_mean)
+    idx = [bag.all_weeks_info[(backtest_year, w)]['idx'] for w in range(1, 53)]
+    actual = np.where(missing[..., idx], suppressed_mean, deaths[..., idx])
+    return a + b * (backtest_year - 2015), actual
+
+def scores(pred, actual):
+    err = pred - actual
+    return {
+        'MAE': np.abs(err).mean(),
+        'RMSE': np.sqrt((err ** 2).mean()),
+        'Bias': err.mean(),
+        # weighted absolute percentage error of the yearly total of each cell
+        'Yearly WAPE %': np.abs(err.sum(axis=-1)).sum() / actual.sum() * 100,
+    }
+
+def sweep(configs):
+    '''Return the DataFrame of scores and excess deaths of each of <configs>,
+    tuples of (predictor, first training year, pandemic start week,
+    suppressed_mean, threshold)'''
+    path = 'Weekly_Counts_of_Deaths_by_Jurisdiction_and_Age.csv'
+    cols = ['Jurisdiction', 'Age Group', 'Year', 'Week', 'Number of Deaths', 'Type', 'Suppress']
+    (jurisdictions, groups, deaths, present, missing) = bag.pivot(bag.weighted_rows(cdcdata.read_csv(path, usecols=cols)))
+    years = list(range(2015, max(backtest_year, max(start[0] for (_, _, start, _, _) in configs) - 1) + 1))
+    cum = stats(deaths, missing, years)
+    # cumulative deaths (counting suppressed weeks as zero) and suppressed
+    # weeks, to total the observed deaths of any range of weeks
+    zero = np.zeros(deaths.shape[:-1] + (1,))
+    cum_obs = np.concatenate([zero, np.cumsum(np.where(missing, 0, deaths), axis=-1)], axis=-1)
+    cum_missing = np.concatenate([zero, np.cumsum(missing, axis=-1)], axis=-1)
+    scored = present & ~np.isin(jurisdictions, aggregates)[:, np.newaxis]
+    rows = []
+    for (predictor, first, start, suppressed_mean, threshold) in configs:
+        (pred, actual) = backtest(cum, years, deaths, missing, first, predictor, suppressed_mean)
+        # excess deaths since the start of the pandemic
+        (a, b) = fit(cum, years, first, start[0] - 1, predictor, suppressed_mean)
+        i = bag.all_weeks_info[start]['idx']
+        (count, sx) = week_weights(bag.all_weeks[i:])
+        exp = a @ count + b @ sx
+        obs = cum_obs[..., -1] - cum_obs[..., i] + suppressed_mean * (cum_missing[..., -1] - cum_missing[..., i])
+        excess = obs - exp
+        ignored = scored & (np.abs(excess) < threshold)
+        kept = scored & ~ignored
+        config = {'Predictor': predictor, 'Training': f'{first}-{start[0] - 1}',
+                'Pandemic start': f'{start[0]}-{start[1]}', 'Suppressed mean': suppressed_mean,
+                'Threshold': threshold}
+        for (k, g) in list(enumerate(groups)) + [(slice(None), 'all')]:
+            rows.append(dict(config, **{'Age Group': g},
+                **scores(pred[:, k][scored[:, k]], actual[:, k][scored[:, k]]),
+                **{'Excess': excess[:, k][kept[:, k]].sum(), 'Ignored cells': ignored[:, k].sum()}))
+    return pd.DataFrame(rows)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--predictor', nargs='+', default=['average', 'linear_regression'],
+            choices=['average', 'linear_regression'])
+    parser.add_argument('--train-start', nargs='+', type=int, default=[2015, 2017], metavar='YEAR',
+            help='first years of the training window (default 2015 2017)')
+    parser.add_argument('--pandemic-start', nargs='+', default=['2020-6'], metavar='YEAR-WEEK',
+            help='MMWR weeks starting the pandemic (default 2020-6)')
+    parser.add_argument('--suppressed-mean', nargs='+', type=float, default=[bag.suppressed_mean],
+            metavar='DEATHS', help=f'deaths assumed for suppressed weeks (default {bag.suppressed_mean})')
+    parser.add_argument('--threshold', nargs='+', type=float, default=[bag.threshold],
+            metavar='DEATHS', help=f'ignore cells with less absolute excess deaths (default {bag.threshold})')
+    parser.add_argument('--output', default='sweep.csv', help='CSV table (default sweep.csv)')
+    args = parser.parse_args()
+    starts = [tuple(map(int, s.split('-'))) for s in args.pandemic_start]
+    if max(args.train_start) > backtest_year - 2:
+        parser.error(f'training must start by {backtest_year - 2} to backtest on {backtest_year}')
+    bag.get_all_weeks()
+    configs = list(itertools.product(args.predictor, args.train_start, starts,
+        args.suppressed_mean, args.threshold))
+    df = sweep(configs)
+    df.to_csv(args.output, index=False)
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(df[df['Age Group'] == 'all'].drop(columns='Age Group').to_string(index=False))
+
+if __name__ == '__main__':
+    main()